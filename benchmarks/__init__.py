@@ -0,0 +1,4 @@
+'''
+Benchmarks for compiling and matching regular expressions. Run them with
+`python -m benchmarks` from the root of the repository.
+'''
@@ -0,0 +1,126 @@
+'''
+Runs the benchmark suite and prints or writes its results as JSON: the
+calls per second of each case, the nanoseconds spent per character of
+input, and the peak memory allocated during one call. Given a baseline
+written by an earlier run, exits with status 1 if any case got slower
+by more than the threshold.
+'''
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from benchmarks.cases import CASES
+
+
+def measure(function, chars, min_time):
+    '''
+    Returns the results of timing `function` in batches until at least
+    `min_time` seconds have passed.
+    '''
+    function()
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+    while True:
+        for index in range(batch):
+            function()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        batch *= 2
+
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    ns_per_char = None
+    if chars:
+        ns_per_char = elapsed * 1e9 / (calls * chars)
+    return {
+        'ops_per_sec': calls / elapsed,
+        'ns_per_char': ns_per_char,
+        'peak_memory': peak_memory,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    Returns the names of the cases whose calls per second fell by more
+    than `threshold` (a fraction) from `baseline`, printing each of them.
+    '''
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        after = result['ops_per_sec']
+        if after < before * (1 - threshold):
+            print('{name}: {before:.1f} -> {after:.1f} ops/sec '
+                  '({change:+.0%})'.format(
+                      name=name, before=before, after=after,
+                      change=after / before - 1), file=sys.stderr)
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Times compiling and matching regular expressions and '
+        'reports the results as JSON.')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run the cases whose names contain this')
+    parser.add_argument('-o', '--output',
+                        help='file to write the results to, instead of '
+                        'standard output')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='largest allowed slowdown relative to the '
+                        'baseline, as a fraction (default: 0.25)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds to spend timing each case '
+                        '(default: 0.2)')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the cases and exit')
+    args = parser.parse_args()
+
+    names = [name for name in CASES if args.filter in name]
+    if args.list:
+        print('\n'.join(names))
+        return
+
+    results = {}
+    for name in names:
+        function, chars = CASES[name]()
+        results[name] = measure(function, chars, args.min_time)
+        print('{name}: {ops:.1f} ops/sec'.format(
+            name=name, ops=results[name]['ops_per_sec']), file=sys.stderr)
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
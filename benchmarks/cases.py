@@ -0,0 +1,185 @@
+'''
+The workloads measured by the benchmark suite. Each case is a function
+that does its setup and returns the callable to time together with the
+number of characters one call reads, or None for cases, such as
+compiling, that read no input.
+'''
+
+from regex import Regex, RegexSet
+
+
+CASES = {}
+
+
+def case(name):
+    def register(function):
+        CASES[name] = function
+        return function
+    return register
+
+
+# compiling
+
+@case('compile/literal')
+def compile_literal():
+    return lambda: Regex('hello|world|help|wordy'), None
+
+
+@case('compile/date')
+def compile_date():
+    return lambda: Regex('[0-9]{4}-[0-9]{2}-[0-9]{2}'), None
+
+
+@case('compile/nested')
+def compile_nested():
+    return lambda: Regex('a((abc)*c)*(b|c(ab)+)?[a-z]*'), None
+
+
+@case('compile/counted')
+def compile_counted():
+    return lambda: Regex('[A-Z]{2}[0-9]{6,12}'), None
+
+
+@case('compile/minimize')
+def compile_minimize():
+    return lambda: Regex('[a-z]+[0-9]*(x|yz)?', minimize=True), None
+
+
+@case('compile/codegen')
+def compile_codegen():
+    return lambda: Regex('[a-z]+[0-9]*(x|yz)?', codegen=True), None
+
+
+@case('compile/set')
+def compile_set():
+    exprs = ['word{index}[a-z]*'.format(index=index) for index in range(100)]
+    return lambda: RegexSet(exprs), None
+
+
+@case('parse/long')
+def parse_long():
+    expr = '|'.join('(ab*c|[d-f]+g?)' for index in range(50))
+    return lambda: Regex.parse(expr), None
+
+
+# pathological patterns, which backtracking engines take exponential
+# time on
+
+@case('test/optional-20')
+def test_optional_20():
+    regex = Regex('(a?){20}a{20}')
+    string = 'a' * 20
+    return lambda: regex.program.simulate(string), len(string)
+
+
+@case('test/optional-50')
+def test_optional_50():
+    regex = Regex('(a?){50}a{50}')
+    string = 'a' * 50
+    return lambda: regex.program.simulate(string), len(string)
+
+
+@case('test/optional-50-dfa')
+def test_optional_50_dfa():
+    regex = Regex('(a?){50}a{50}', dfa=True)
+    string = 'a' * 50
+    return lambda: regex.dfa.simulate(string), len(string)
+
+
+@case('test/nested-star')
+def test_nested_star():
+    regex = Regex('(a*)*b')
+    string = 'a' * 1000
+    return lambda: regex.program.simulate(string), len(string)
+
+
+@case('test/nested-star-dfa')
+def test_nested_star_dfa():
+    regex = Regex('(a*)*b', dfa=True)
+    string = 'a' * 1000
+    return lambda: regex.dfa.simulate(string), len(string)
+
+
+@case('test/nested-star-prefilter')
+def test_nested_star_prefilter():
+    regex = Regex('(a*)*b')
+    string = 'a' * 1000
+    return lambda: regex.test(string), len(string)
+
+
+# wide classes and long inputs
+
+@case('test/wide-class')
+def test_wide_class():
+    regex = Regex('[\u0000-\uffff]*x[\u0100-\uffff]')
+    string = 'abc\u00e9\u4e00' * 2000 + 'x\u4e00'
+    return lambda: regex.test(string), len(string)
+
+
+@case('test/wide-class-binary')
+def test_wide_class_binary():
+    regex = Regex('[\u0000-\uffff]*x[\u0100-\uffff]', binary=True)
+    string = ('abc\u00e9\u4e00' * 2000 + 'x\u4e00').encode('utf-8')
+    return lambda: regex.test(string), len(string)
+
+
+@case('test/long-program')
+def test_long_program():
+    regex = Regex('([a-z]|[0-9])*(x|yz)')
+    string = 'abc123' * 10000 + 'yz'
+    return lambda: regex.program.simulate(string), len(string)
+
+
+@case('test/long-dfa')
+def test_long_dfa():
+    regex = Regex('([a-z]|[0-9])*(x|yz)', dfa=True)
+    string = 'abc123' * 10000 + 'yz'
+    return lambda: regex.test(string), len(string)
+
+
+@case('test/long-minimal')
+def test_long_minimal():
+    regex = Regex('([a-z]|[0-9])*(x|yz)', minimize=True)
+    string = 'abc123' * 10000 + 'yz'
+    return lambda: regex.test(string), len(string)
+
+
+@case('test/long-codegen')
+def test_long_codegen():
+    regex = Regex('([a-z]|[0-9])*(x|yz)', codegen=True)
+    string = 'abc123' * 10000 + 'yz'
+    return lambda: regex.test(string), len(string)
+
+
+@case('search/long')
+def search_long():
+    regex = Regex('ne+dle[0-9]+')
+    string = 'haystack ' * 10000 + 'needle42'
+    return lambda: regex.search(string), len(string)
+
+
+@case('findall/long')
+def findall_long():
+    regex = Regex('[0-9]+')
+    string = 'abc 123 de 4 fghij 56789 ' * 1000
+    return lambda: regex.findall(string), len(string)
+
+
+# many patterns
+
+@case('set/matches')
+def set_matches():
+    regex_set = RegexSet(
+        ['word{index}[a-z]*'.format(index=index) for index in range(100)],
+        dfa=True)
+    string = 'word42' + 'abc' * 1000
+    return lambda: regex_set.matches(string), len(string)
+
+
+@case('test/batch')
+def test_batch():
+    regex = Regex('http://example/(a|b)+/[0-9]+')
+    strings = ['http://example/{path}/{index}'.format(
+        path='ab' * (index % 7 + 1), index=index) for index in range(1000)]
+    chars = sum(len(string) for string in strings)
+    return lambda: regex.test_batch(strings), chars
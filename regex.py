@@ -1,4 +1,42 @@
+import argparse
+import asyncio
+import builtins
+import codecs
+import mmap
+import os
+import struct
 import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+OP_CHAR = 0
+OP_CLASS = 1
+OP_SPLIT = 2
+OP_MATCH = 3
+
+
+class PatternError(ValueError):
+    '''
+    Raised for a malformed pattern, with the offset in the pattern at
+    which the problem was found.
+    '''
+
+    def __init__(self, message, position):
+        super(PatternError, self).__init__(
+            '{message} at position {position}'.format(
+                message=message, position=position))
+        self.position = position
 
 
 class Token(object):
@@ -6,21 +44,18 @@ class Token(object):
     Represents a character or set of characters to be converted into NFA
     representation by the NFA static methods. Tokens are generated and
     consumed in the Regex class. Token object is responsible for
-    expanding hyphenated ranges into literal ranges.
+    converting its value, which may contain hyphenated ranges, into the
+    CharClass of characters it matches.
     '''
 
-    def __init__(self, type, value=''):
+    __slots__ = ('type', 'value', 'chars')
+
+    def __init__(self, type, value='', chars=None):
         self.type = type
-        self.value = ''
-        for index, c in enumerate(value):
-            if c == '-':
-                from_ascii_code = ord(value[index-1])
-                to_ascii_code = ord(value[index+1])
-                for code in range(from_ascii_code, to_ascii_code+1):
-                    self.value += chr(code)
-            else:
-                # FIXME redundant chars
-                self.value += c
+        self.value = value
+        if chars is None and type == 'literal':
+            chars = CharClass.parse(value)
+        self.chars = chars
 
     def __eq__(self, other):
         return (
@@ -39,322 +74,3225 @@ class Token(object):
         return self.__str__()
 
 
-class Regex(object):
+class CharClass(object):
+    '''
+    A set of characters stored as a sorted list of disjoint, non-adjacent
+    (first, last) code point ranges, so that its size does not depend on
+    the width of the ranges. Membership of characters below
+    BITMAP_SIZE is a single bit test; other characters are found by
+    binary search over the range starts.
+    '''
+
+    __slots__ = ('ranges', 'starts', 'bitmap')
+
+    BITMAP_SIZE = 256
+
+    def __init__(self, ranges=()):
+        merged = []
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                if last > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], last)
+            else:
+                merged.append((first, last))
+        self.ranges = tuple(merged)
+        self.starts = [first for first, last in merged]
+
+        self.bitmap = 0
+        for first, last in merged:
+            if first >= CharClass.BITMAP_SIZE:
+                break
+            last = min(last, CharClass.BITMAP_SIZE - 1)
+            self.bitmap |= ((1 << (last - first + 1)) - 1) << first
+
+    @staticmethod
+    def parse(value):
+        '''
+        Builds a CharClass from the contents of a bracket expression,
+        where `x-y` is the range of characters from x to y. A hyphen at
+        either end is a literal hyphen.
+        '''
+        ranges = []
+        index = 0
+        while index < len(value):
+            if index + 2 < len(value) and value[index+1] == '-':
+                first, last = ord(value[index]), ord(value[index+2])
+                if first > last:
+                    raise ValueError('Invalid range {range}'.format(
+                        range=value[index:index+3]))
+                ranges.append((first, last))
+                index += 3
+            else:
+                ranges.append((ord(value[index]), ord(value[index])))
+                index += 1
+
+        return CharClass(ranges)
+
+    def __contains__(self, c):
+        return self.includes(ord(c))
+
+    def includes(self, code):
+        '''
+        Returns True if the character with code point `code` is in the
+        class.
+        '''
+        if code < CharClass.BITMAP_SIZE:
+            return (self.bitmap >> code) & 1 == 1
+        index = bisect_right(self.starts, code) - 1
+        return index >= 0 and code <= self.ranges[index][1]
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, self.__class__)
+            and self.ranges == other.ranges
+        )
+
+    def __hash__(self):
+        return hash(self.ranges)
+
+    def __str__(self):
+        return 'CharClass({ranges})'.format(ranges=', '.join(
+            '{first}-{last}'.format(first=chr(first), last=chr(last))
+            if first != last else chr(first)
+            for first, last in self.ranges))
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# the token of every epsilon edge
+EPSILON = Token('literal', '')
+
+
+class PatternCache(object):
     '''
-    Wrapper for an NFA that corresponds to a given regular expression.
-    This class is responsible for parsing the regular expression into a
-    convenient string format and then constructing the NFA.
+    A thread-safe, bounded cache of compiled Regex objects keyed on the
+    pattern and the flags it was compiled with. When full, the least
+    recently used entry is evicted. Hits and misses are counted, so the
+    cache can be sized to the patterns actually in use.
     '''
 
-    def __init__(self, expr):
+    MAX_SIZE = 512
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, expr, **flags):
+        '''
+        Returns the cached Regex for `expr` and `flags`, compiling and
+        caching it on a miss.
+        '''
+        key = (type(expr), expr, tuple(sorted(flags.items())))
+        with self.lock:
+            regex = self.entries.get(key)
+            if regex is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return regex
+            self.misses += 1
+
+        # compile outside the lock; a concurrent miss on the same key
+        # compiles twice, but both results are equivalent
+        regex = Regex(expr, **flags)
+        with self.lock:
+            self.entries[key] = regex
+            self.entries.move_to_end(key)
+            self.evict()
+        return regex
+
+    def evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def resize(self, max_size):
+        '''
+        Changes the maximum number of cached patterns, evicting the
+        least recently used ones if needed.
+        '''
+        with self.lock:
+            self.max_size = max_size
+            self.evict()
+
+    def purge(self):
+        '''
+        Empties the cache and resets its counters.
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
         '''
-        Compiles an NFA given a regular expression pattern.
+        Returns the cache counters as a dict.
         '''
-        nfa_stack = []
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'max_size': self.max_size,
+            }
+
+
+cache = PatternCache()
+
+
+def compile(expr, **flags):
+    '''
+    Returns a Regex for `expr` compiled with the given Regex keyword
+    arguments, reusing a cached one when the same pattern was compiled
+    with the same flags before.
+    '''
+    return cache.get(expr, **flags)
+
 
+def purge():
+    '''
+    Empties the cache of compiled patterns.
+    '''
+    cache.purge()
+
+
+class Regex(object):
+    '''
+    A compiled regular expression. The pattern is parsed into postfix
+    tokens in a single pass, and the tokens are compiled straight into
+    a Program, which the matching engines run; its NFA as a graph is
+    only built when asked for.
+    '''
+
+    # the most tokens the counted repetitions of a pattern may add to it
+    # once they are expanded
+    MAX_SIZE = 10000
+
+    def __init__(self, expr, dfa=False, max_dfa_states=None, binary=False,
+                 minimize=False, codegen=False):
+        '''
+        Compiles an NFA given a regular expression pattern. If `dfa` is
+        true, matching goes through a lazily built DFA whose state cache
+        holds at most `max_dfa_states` states. If `binary` is true, the
+        NFA matches the UTF-8 encoding of the pattern's characters in
+        bytes-like objects instead of strings. If `minimize` is true,
+        the NFA is converted to a minimal DFA up front, which is used
+        for matching unless it would have more than `max_dfa_states`
+        states (MinimalDFA.MAX_STATES by default). If `codegen` is true,
+        the minimal DFA is also compiled into a Python function, when it
+        has at most MinimalDFA.MAX_CODEGEN_STATES states.
+        '''
+        self.expr = expr
+        self.max_dfa_states = max_dfa_states
+        self.binary = binary
         tokens = Regex.parse(expr)
+        # the program is compiled from the tokens directly; the graph is
+        # built by the nfa property when it is asked for
+        self.program = Program.from_tokens(tokens, binary)
+        self.graph = None
+        self.prefilter = Prefilter.from_tokens(tokens, binary)
+        self.fast_path = FastPath.from_tokens(tokens, binary)
 
-        for token in tokens:
-            if token.type == '|':
-                nfa1 = nfa_stack.pop()
-                nfa2 = nfa_stack.pop()
-                nfa_stack.append(NFA.union(nfa1, nfa2))
-            elif token.type == '*':
-                nfa_stack.append(NFA.star(nfa_stack.pop()))
-            elif token.type == '+':
-                nfa_stack.append(NFA.plus(nfa_stack.pop()))
-            elif token.type == '?':
-                nfa_stack.append(NFA.question(nfa_stack.pop()))
-            elif token.type == '.':
-                nfa2 = nfa_stack.pop()
-                nfa1 = nfa_stack.pop()
-                nfa_stack.append(NFA.concat(nfa1, nfa2))
-            else:
-                nfa_stack.append(NFA.literal(token))
+        self.dfa = None
+        if dfa:
+            if max_dfa_states is None:
+                max_dfa_states = DFA.MAX_STATES
+            self.dfa = DFA(self.program, max_states=max_dfa_states)
+
+        self.minimize = minimize
+        self.codegen = codegen
+        self.minimal_dfa = None
+        if minimize or codegen:
+            self.minimal_dfa = MinimalDFA.from_program(
+                self.program, max_dfa_states or MinimalDFA.MAX_STATES)
+        if codegen and self.minimal_dfa:
+            self.minimal_dfa.compile_function()
+        # built by test_array if needed, without switching test over
+        self.array_dfa = self.minimal_dfa
+
+        # instrumentation, off unless enable_stats is called
+        self.recorder = None
+        self.sink = None
 
-        self.nfa = nfa_stack.pop()
+    @property
+    def nfa(self):
+        '''
+        The NFA of the pattern, as a graph of State and Edge objects
+        built from the program's tables the first time it is asked for.
+        '''
+        if self.graph is None:
+            self.graph = NFA.from_program(self.program)
+        return self.graph
+
+    def __reduce__(self):
+        # pickled as its pattern and flags, and compiled again on load
+        return (Regex, (self.expr, self.dfa is not None, self.max_dfa_states,
+                        self.binary, self.minimize, self.codegen))
 
     @staticmethod
     def parse(expr):
-        return Regex.tokenize(
-            Regex.convert_infix_to_post(Regex.insert_concat_operator(expr)))
+        '''
+        Returns the postfix tokens of `expr` in a single pass over it,
+        with the shunting-yard algorithm: concatenation is implied
+        between adjacent operands and emitted as '.', and postfix
+        operators bind tightest so they go straight to the output. '.'
+        in the pattern is a literal. Literal tokens are shared by equal
+        literals, so each character class is parsed once. Counted
+        repetitions are expanded in place by Regex.repeat as they are
+        read. An empty pattern, group or alternative matches the empty
+        string. Raises PatternError, with the position of the problem,
+        if the pattern is malformed.
+        '''
+        precedence = {'.': 1, '|': 2}
+        operators = {}
+        literals = {}
+        output = []
+        # pending '.', '|' and '(' with their positions
+        stack = []
+        # where the output of each open group starts, and where that of
+        # the last operand does, which is what a repetition applies to
+        groups = []
+        operand = 0
+        expanded = 0
 
-    @staticmethod
-    def tokenize(expr):
-        tokens = []
-        position = 0
-        while True:
-            if position == len(expr):
-                break
+        def operator(type):
+            if type not in operators:
+                operators[type] = Token(type)
+            return operators[type]
 
-            if expr[position] == '[':
-                current_chars = ''
-                position += 1
-                while expr[position] != ']':
-                    current_chars += expr[position]
-                    position += 1
-                tokens.append(Token('literal', current_chars))
-            elif expr[position] in '*?+.|':
-                tokens.append(Token(expr[position]))
-            else:
-                tokens.append(Token('literal', expr[position]))
+        def push(type, position):
+            while (stack and stack[-1][0] != '('
+                   and precedence[type] >= precedence[stack[-1][0]]):
+                output.append(operator(stack.pop()[0]))
+            stack.append((type, position))
+
+        expect_operand = True
+        position = 0
+        while position < len(expr):
+            c = expr[position]
+            start = position
             position += 1
+            value = None
+            if c == '[':
+                end = expr.find(']', position)
+                if end == -1:
+                    raise PatternError('unclosed [', start)
+                value = expr[position:end]
+                position = end + 1
+            elif c == '(':
+                if not expect_operand:
+                    push('.', start)
+                stack.append(('(', start))
+                groups.append(len(output))
+                expect_operand = True
+            elif c == ')':
+                if expect_operand:
+                    output.append(EPSILON)
+                while stack and stack[-1][0] != '(':
+                    output.append(operator(stack.pop()[0]))
+                if not stack:
+                    raise PatternError('unbalanced )', start)
+                stack.pop()
+                operand = groups.pop()
+                expect_operand = False
+            elif c == '|':
+                if expect_operand:
+                    output.append(EPSILON)
+                push('|', start)
+                expect_operand = True
+            elif c in '*+?' or c == '{':
+                try:
+                    repeat = c == '{' and Regex.read_repeat(expr, start)
+                except ValueError as error:
+                    raise PatternError(str(error), start)
+                if c == '{' and not repeat:
+                    value = c
+                elif expect_operand:
+                    raise PatternError('nothing to repeat', start)
+                elif repeat:
+                    position, minimum, maximum = repeat
+                    count = minimum if maximum is None else maximum
+                    # each copy of the operand comes with a '.' and a '?'
+                    length = len(output) - operand
+                    expanded += (length + 2) * max(count, 1) - length
+                    if expanded > Regex.MAX_SIZE:
+                        raise PatternError('pattern is too large once its '
+                                           'repetitions are expanded', start)
+                    output[operand:] = Regex.repeat(
+                        output[operand:], minimum, maximum, operator)
+                else:
+                    output.append(operator(c))
+            else:
+                value = c
+
+            if value is not None:
+                if not expect_operand:
+                    push('.', start)
+                if value not in literals:
+                    try:
+                        literals[value] = Token('literal', value)
+                    except ValueError as error:
+                        raise PatternError(str(error), start)
+                operand = len(output)
+                output.append(literals[value])
+                expect_operand = False
 
-        return tokens
+        if expect_operand:
+            output.append(EPSILON)
+        while stack:
+            type, position = stack.pop()
+            if type == '(':
+                raise PatternError('unclosed (', position)
+            output.append(operator(type))
+
+        return output
 
     @staticmethod
-    def convert_infix_to_post(expr):
+    def read_repeat(expr, position):
         '''
-        Converts a regular expression with literal concat operator to
-        postfix notation via Dijkstra's shunting-yard algorithm.
+        Reads a counted repetition `{m}`, `{m,}`, `{m,n}` or `{,n}` at
+        `position` and returns the position after it with the minimum
+        and maximum counts (None if unbounded), or None if there is no
+        repetition there, in which case the brace is a literal.
         '''
-        precedence = {
-            '*': 0,
-            '?': 0,
-            '+': 0,
-            '.': 1,
-            '|': 2
-        }
-        output_queue = []
-        operator_stack = []
-
-        def top_of_stack():
-            return operator_stack[len(operator_stack)-1]
-
-        for index, c in enumerate(expr):
-            if c in precedence:
-                while (0 != len(operator_stack)
-                       and '(' != top_of_stack()
-                       and precedence[c] >= precedence[top_of_stack()]):
-                    output_queue.append(operator_stack.pop())
-                operator_stack.append(c)
-            elif '(' == c:
-                operator_stack.append(c)
-            elif ')' == c:
-                while '(' != top_of_stack():
-                    output_queue.append(operator_stack.pop())
-                if '(' == top_of_stack():
-                    operator_stack.pop()
-            else:
-                output_queue.append(c)
+        if expr[position] != '{':
+            return None
+        end = expr.find('}', position)
+        if end == -1:
+            return None
+        counts = expr[position + 1:end].split(',')
+        if len(counts) > 2 or not all(
+                count == '' or count.isdigit() for count in counts):
+            return None
+        if counts[0] == '' and (len(counts) == 1 or counts[1] == ''):
+            return None
+        minimum = int(counts[0] or 0)
+        if len(counts) == 1:
+            maximum = minimum
+        else:
+            maximum = int(counts[1]) if counts[1] else None
+        if maximum is not None and maximum < minimum:
+            raise ValueError('invalid repetition {text}'.format(
+                text=expr[position:end + 1]))
+        return end + 1, minimum, maximum
+
+    @staticmethod
+    def repeat(operand, minimum, maximum, operator=Token):
+        '''
+        Returns the postfix tokens of the postfix `operand` repeated from
+        `minimum` to `maximum` times (or more, if `maximum` is None), in
+        time linear in their length. Optional copies are nested, so that
+        `x{2,4}` becomes `xx(x(x)?)?` rather than `xxx?x?`, whose NFA has
+        an epsilon path from every copy to every later one: its postfix
+        is `xx.xx?.?.`, the copies followed by the operators closing the
+        nested groups from the inside out. The copies share their
+        tokens, and so their character classes. `operator` returns the
+        token of an operator.
+        '''
+        output = []
+        mandatory = minimum
+        if maximum is None and minimum:
+            mandatory -= 1
+        for index in range(mandatory):
+            output.extend(operand)
+            if index:
+                output.append(operator('.'))
 
-        while 0 != len(operator_stack):
-            output_queue.append(operator_stack.pop())
+        if maximum is None:
+            output.extend(operand)
+            output.append(operator('+' if minimum else '*'))
+        elif maximum > minimum:
+            for index in range(maximum - minimum):
+                output.extend(operand)
+            output.append(operator('?'))
+            for index in range(maximum - minimum - 1):
+                output.append(operator('.'))
+                output.append(operator('?'))
+        else:
+            return output or [EPSILON]
+        if mandatory:
+            output.append(operator('.'))
+        return output
 
-        return ''.join(output_queue)
+    def test(self, string, limits=None):
+        if limits is not None:
+            return self.limited_test(string, limits)
+        if self.recorder is not None:
+            return self.recorded_test(string)
+        check_type(string, self.binary)
+        if self.fast_path and isinstance(string, self.fast_path.types):
+            return self.fast_path.test(string)
+        if self.prefilter and self.prefilter.rejects(string):
+            return False
+        if self.minimal_dfa:
+            return self.minimal_dfa.simulate(string)
+        if self.dfa:
+            return self.dfa.simulate(string)
+        return self.program.simulate(string)
 
-    @staticmethod
-    def insert_concat_operator(expr):
+    def limited_test(self, string, limits):
+        '''
+        Does what `test` does within the Limits `limits`. Raises
+        LimitExceeded if the limits are exceeded. While stats are
+        enabled, the call is recorded even if it raises.
+        '''
+        check_type(string, self.binary)
+        budget = limits.start(len(string))
+        stats = Stats(len(self.program.ops))
+        stats.calls = 1
+        misses = self.dfa.misses if self.dfa else 0
+        try:
+            return self.run_limited(string, budget, stats)
+        finally:
+            if self.recorder is not None:
+                stats.chars = budget.chars
+                if 'dfa' in stats.engines:
+                    stats.dfa_misses = self.dfa.misses - misses
+                    stats.dfa_hits = stats.chars - stats.dfa_misses
+                self.record(stats)
+
+    def run_limited(self, string, budget, stats):
+        '''
+        Tests `string`, feeding the automaton a slice at a time and
+        charging each slice to `budget`, and notes the engine used in
+        `stats`.
+        '''
+        if self.fast_path and isinstance(string, self.fast_path.types):
+            stats.engines['fast_path'] = 1
+            return self.fast_path.test(string)
+        if self.prefilter and self.prefilter.rejects(string):
+            stats.engines['prefilter'] = 1
+            return False
+
+        if self.minimal_dfa or (self.dfa and
+                                self.dfa.flushes <= self.dfa.max_flushes):
+            dfa = self.minimal_dfa or self.dfa
+            stats.engines['minimal_dfa' if self.minimal_dfa else 'dfa'] = 1
+            state = 0 if self.minimal_dfa else dfa.start_state
+            for chunk in iter_slices(string, Budget.INTERVAL):
+                state = dfa.run(state, iter_codes(chunk))
+                budget.spend(len(chunk), len(chunk))
+                if self.minimal_dfa:
+                    if state == dfa.dead or state == dfa.universal:
+                        break
+                elif not state.nfa_states:
+                    break
+            if self.minimal_dfa:
+                return bool(dfa.accepting[state])
+            return state.is_match
+
+        stats.engines['program'] = 1
+        return self.program.is_match(
+            self.program.run(self.program.start_states, string, budget))
+
+    def enable_stats(self, sink=None):
+        '''
+        Starts recording counters for the calls to `test`, which `stats`
+        returns. If `sink` is given, it is called after each call with
+        the regex and a dict of the counters of that call alone. While
+        stats are disabled, `test` only pays one attribute check.
+        '''
+        self.recorder = Stats(len(self.program.ops))
+        self.sink = sink
+
+    def disable_stats(self):
+        '''
+        Stops recording counters and drops those recorded so far.
+        '''
+        self.recorder = None
+        self.sink = None
+
+    def stats(self):
+        '''
+        Returns a dict of the counters recorded since `enable_stats` was
+        called, or None if stats are disabled.
+        '''
+        if self.recorder is None:
+            return None
+        return self.recorder.as_dict()
+
+    def recorded_test(self, string):
+        '''
+        Does what `test` does, recording which engine answered and what
+        it cost.
+        '''
+        check_type(string, self.binary)
+        stats = Stats(len(self.program.ops))
+        stats.calls = 1
+        if self.fast_path and isinstance(string, self.fast_path.types):
+            engine = 'fast_path'
+            result = self.fast_path.test(string)
+        elif self.prefilter and self.prefilter.rejects(string):
+            engine = 'prefilter'
+            result = False
+        elif self.minimal_dfa:
+            engine = 'minimal_dfa'
+            stats.chars = len(string)
+            result = self.minimal_dfa.simulate(string)
+        elif self.dfa and self.dfa.flushes <= self.dfa.max_flushes:
+            engine = 'dfa'
+            stats.chars = len(string)
+            misses = self.dfa.misses
+            result = self.dfa.simulate(string)
+            stats.dfa_misses = self.dfa.misses - misses
+            stats.dfa_hits = stats.chars - stats.dfa_misses
+        else:
+            engine = 'program'
+            result = self.program.record(string, stats)
+        stats.engines[engine] = 1
+
+        self.record(stats)
+        return result
+
+    def record(self, stats):
+        '''
+        Adds the Stats of a call to those recorded, and passes them to
+        the sink.
         '''
-        Inserts a literal concatenation operator '.' into a regular
-        expression.
+        self.recorder.add(stats)
+        if self.sink is not None:
+            self.sink(self, stats.as_dict())
+
+    def test_array(self, column):
+        '''
+        Tests every string of a NumPy array of fixed-width strings (or of
+        bytes, for a binary Regex) at once and returns a boolean array of
+        the results. The rows are advanced through the minimal DFA one
+        character position at a time, so the work done in Python grows
+        with the width of the strings rather than with their number.
+        Raises ValueError if the minimal DFA would have more than
+        `max_dfa_states` states.
+        '''
+        if numpy is None:
+            raise ImportError('test_array requires numpy')
+        column = numpy.asarray(column)
+        kind = 'S' if self.binary else 'U'
+        if column.dtype.kind != kind:
+            raise TypeError('expected an array of dtype {kind}, got '
+                            '{dtype}'.format(kind=kind, dtype=column.dtype))
+        if self.array_dfa is None:
+            self.array_dfa = MinimalDFA.from_program(
+                self.program, self.max_dfa_states or MinimalDFA.MAX_STATES)
+            if self.array_dfa is None:
+                raise ValueError('DFA has too many states for test_array')
+        return self.array_dfa.simulate_array(column)
+
+    def test_batch(self, strings):
+        '''
+        Tests every string of the iterable `strings` and returns the list
+        of results, in input order. The strings are visited in sorted
+        order, keeping the active states after each prefix of the last
+        string, so that a prefix shared by consecutive strings is only
+        simulated once, as if walking a trie of the strings.
+        '''
+        strings = list(strings)
+        for index, string in enumerate(strings):
+            check_type(string, self.binary)
+            if self.binary and not isinstance(string, bytes):
+                # memoryviews and mmaps cannot be sorted or compared
+                # byte by byte, so they are copied
+                strings[index] = bytes(string)
+
+        if self.dfa and self.dfa.flushes <= self.dfa.max_flushes:
+            dfa = self.dfa
+            start = dfa.start_state
+
+            def advance(state, code):
+                return dfa.run(state, (code,))
+
+            def is_live(state):
+                return bool(state.nfa_states)
+
+            def is_match(state):
+                return state.is_match
+        else:
+            start = self.program.start_states
+            advance = self.program.step
+            is_live = bool
+            is_match = self.program.is_match
+
+        results = [False] * len(strings)
+        # path[i] is the state after the first i characters of the last
+        # string, up to the point where no states were left
+        path = [start]
+        previous = None
+        for index in sorted(range(len(strings)), key=strings.__getitem__):
+            string = strings[index]
+            if previous is not None:
+                common = 0
+                length = min(len(previous), len(string))
+                while common < length and previous[common] == string[common]:
+                    common += 1
+                del path[common + 1:]
+
+            state = path[-1]
+            if is_live(state):
+                for code in iter_codes(string[len(path) - 1:]):
+                    state = advance(state, code)
+                    path.append(state)
+                    if not is_live(state):
+                        break
+
+            results[index] = (len(path) == len(string) + 1
+                              and is_match(path[-1]))
+            previous = string
+
+        return results
+
+    def test_many(self, strings, workers=None, chunksize=1000, mask=False):
+        '''
+        Tests every string of the iterable `strings` on a pool of
+        `workers` processes (by default one per CPU), sending them
+        `chunksize` strings at a time. Each worker compiles the pattern
+        once. Returns an iterator over the results in input order, or if
+        `mask` is true a bytearray holding 1 for each string that
+        matches and 0 for the others. With `workers` set to 1, strings
+        are tested in this process.
+        '''
+        results = self.iter_test_many(strings, workers, chunksize)
+        if mask:
+            return bytearray(results)
+        return (result == 1 for result in results)
+
+    def iter_test_many(self, strings, workers, chunksize):
+        '''
+        Yields 1 or 0 for each string, as described in test_many.
+        '''
+        if workers is None:
+            workers = os.cpu_count() or 1
+        chunks = iter_chunks(strings, chunksize)
+
+        if workers == 1:
+            for chunk in chunks:
+                for string in chunk:
+                    yield 1 if self.test(string) else 0
+            return
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(self,)) as executor:
+            # keep a bounded number of chunks in flight, so the input is
+            # consumed as results are produced
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(test_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    for result in pending.popleft().result():
+                        yield result
+            while pending:
+                for result in pending.popleft().result():
+                    yield result
+
+    def search(self, string, pos=0, limits=None):
+        '''
+        Returns a Match for the leftmost-longest substring of `string`
+        starting at or after `pos` that the expression matches, or None.
+        If `limits` are given, raises LimitExceeded when the search goes
+        over them.
+        '''
+        check_type(string, self.binary)
+        # like re, a start outside the string is moved to its nearest end
+        pos = max(0, min(pos, len(string)))
+        budget = None
+        if limits is not None:
+            budget = limits.start(len(string) - pos)
+        if self.prefilter:
+            pos = self.prefilter.find_start(string, pos)
+            if pos == -1:
+                return None
+        span = self.program.search(string, pos, budget)
+        if span is None:
+            return None
+        return Match(string, span[0], span[1])
+
+    def finditer(self, string):
+        '''
+        Yields a Match for every non-overlapping leftmost-longest match
+        in `string`, from left to right. An empty match is never
+        followed by another match at the same position.
+        '''
+        pos = 0
+        while pos <= len(string):
+            match = self.search(string, pos)
+            if match is None:
+                return
+            yield match
+            pos = match.end if match.end > match.start else match.end + 1
+
+    def findall(self, string):
+        '''
+        Returns the substrings matched by finditer, as a list.
+        '''
+        return [match.group() for match in self.finditer(string)]
+
+    def matcher(self, search=False):
         '''
-        converted = []
-        ignore = False
-        for index, c in enumerate(expr):
-            converted.append(c)
-            if index < len(expr)-1:
-                c2 = expr[index+1]
+        Returns a Matcher that tests, or if `search` is true searches,
+        input fed to it in chunks.
+        '''
+        return Matcher(self.program, search=search, dfa=self.dfa,
+                       binary=self.binary)
+
+    async def atest(self, string, budget=None):
+        '''
+        Coroutine version of test for event loops: the string is matched
+        `budget` characters (CHUNK_SIZE by default) at a time, yielding
+        to the loop in between, so a long input does not block other
+        tasks.
+        '''
+        check_type(string, self.binary)
+        budget = budget or CHUNK_SIZE
+        if len(string) <= budget:
+            return self.test(string)
+        if self.prefilter and self.prefilter.rejects(string):
+            return False
+        matcher = self.matcher()
+        for chunk in iter_slices(string, budget):
+            matcher.feed(chunk)
+            await asyncio.sleep(0)
+        return matcher.finish()
+
+    async def asearch(self, string, pos=0, budget=None):
+        '''
+        Coroutine version of search, reading `budget` characters at a
+        time and yielding to the event loop in between.
+        '''
+        check_type(string, self.binary)
+        pos = max(0, min(pos, len(string)))
+        budget = budget or CHUNK_SIZE
+        if len(string) - pos <= budget:
+            return self.search(string, pos)
+        if self.prefilter:
+            pos = self.prefilter.find_start(string, pos)
+            if pos == -1:
+                return None
+        matcher = self.matcher(search=True)
+        spans = []
+        for chunk in iter_slices(string, budget, pos):
+            spans = matcher.feed(chunk)
+            if spans:
+                break
+            await asyncio.sleep(0)
+        else:
+            spans = matcher.finish()
+        if not spans:
+            return None
+        start, end = spans[0]
+        return Match(string, pos + start, pos + end)
+
+
+class RegexSet(object):
+    '''
+    A collection of patterns matched together in a single pass over the
+    input. The patterns' programs are merged into one whose accept
+    states are tagged with the index of their pattern, so the cost of
+    matching depends on the length of the input rather than on the
+    number of patterns.
+    '''
+
+    def __init__(self, exprs, dfa=False, max_dfa_states=None, binary=False):
+        '''
+        Compiles the patterns `exprs`, which may be strings or Regex
+        objects compiled with the same `binary` flag. `dfa` and
+        `max_dfa_states` are as for Regex.
+        '''
+        self.binary = binary
+        self.regexes = []
+        for expr in exprs:
+            if not isinstance(expr, Regex):
+                expr = Regex(expr, binary=binary)
+            elif expr.binary != binary:
+                raise ValueError('cannot mix binary and string patterns')
+            self.regexes.append(expr)
+
+        self.program = Program.merge(
+            [regex.program for regex in self.regexes])
 
-                # treat [*] as a unit
-                if c == '[':
-                    ignore = True
-                elif c == ']':
-                    ignore = False
+        self.dfa = None
+        if dfa:
+            if max_dfa_states is None:
+                max_dfa_states = DFA.MAX_STATES
+            self.dfa = DFA(self.program, max_states=max_dfa_states)
 
-                if not ignore and c not in '(|' and c2 not in ')|*?+':
-                    converted.append('.')
+    def __len__(self):
+        return len(self.regexes)
 
-        return ''.join(converted)
+    def matches(self, string):
+        '''
+        Returns the sorted indices of the patterns that match `string`.
+        '''
+        check_type(string, self.binary)
+        if self.dfa and self.dfa.flushes <= self.dfa.max_flushes:
+            active_states = self.dfa.run(
+                self.dfa.start_state, iter_codes(string)).nfa_states
+        else:
+            active_states = self.program.start_states
+            for code in iter_codes(string):
+                active_states = self.program.step(active_states, code)
+
+        return self.program.matching_tags(active_states)
 
     def test(self, string):
-        return self.nfa.simulate(string)
+        '''
+        Returns True if any of the patterns matches `string`.
+        '''
+        check_type(string, self.binary)
+        if self.dfa:
+            return self.dfa.simulate(string)
+        return self.program.simulate(string)
 
 
-class NFA(object):
+class Archive(object):
     '''
-    An NFA is a collection of linked state structures with a start state
-    and a set of matching states. The NFA works by reading a string and
-    updating a state list according to each state's out edges. The NFA
-    accepts a string if the final state list contains a matching state,
-    and rejects it otherwise. This class contains constructor methods
-    corresponding to the regular operations. It can simulate the NFA
-    given a string and decide whether the string is in the regular
-    language it represents or not.
+    A file of precompiled patterns. Each pattern is stored with the
+    tables of its minimal DFA, which are used in place through a memory
+    map when the archive is loaded, so no pattern is parsed or built
+    again. Patterns whose DFA was over budget are stored as source only
+    and compiled the first time they are needed.
+
+    The file starts with a header (magic, format version, byte order,
+    flags, pattern count and a CRC-32 of the rest of the file), followed
+    by one record per pattern: a header of int32 lengths and state
+    numbers, then the pattern in UTF-8 and the int32 alphabet and
+    transition tables, each padded to a multiple of 4 bytes. Integers
+    are in the byte order of the machine that wrote the file.
     '''
 
-    def __init__(self, start_state, accept_states):
-        self.start_state = start_state
-        self.accept_states = accept_states
+    MAGIC = b'RGXA'
+    VERSION = 2
+    HEADER = struct.Struct('=4sHBBII')
+    RECORD = struct.Struct('=7i')
+    BINARY = 1
+
+    def __init__(self, data, exprs, dfas, binary, mapping=None):
+        self.data = data
+        self.exprs = exprs
+        self.dfas = dfas
+        self.binary = binary
+        self.mapping = mapping
+        self.regexes = {}
 
     @staticmethod
-    def epsilon():
+    def dump(exprs, path, binary=False, max_dfa_states=None):
         '''
-        Return a new literal token containing the empty string.
+        Compiles the patterns `exprs` and writes them to the file at
+        `path`. `binary` and `max_dfa_states` are as for Regex.
         '''
-        return Token('literal', '')
+        records = []
+        for expr in exprs:
+            regex = Regex(expr, binary=binary, minimize=True,
+                          max_dfa_states=max_dfa_states)
+            records.append(Archive.pack(expr, regex.minimal_dfa))
+        body = b''.join(records)
+        header = Archive.HEADER.pack(
+            Archive.MAGIC, Archive.VERSION, sys.byteorder == 'little',
+            Archive.BINARY if binary else 0, len(records), zlib.crc32(body))
+        with open(path, 'wb') as stream:
+            stream.write(header)
+            stream.write(body)
 
     @staticmethod
-    def literal(token):
+    def pack(expr, dfa):
         '''
-        Returns an NFA for a literal character
+        Returns the record of a pattern and its minimal DFA, or of the
+        pattern alone if `dfa` is None.
         '''
-        accept_state = State(is_match=True)
-        edge = Edge(token, accept_state)
-        start_state = State(edge)
-        return NFA(start_state, [accept_state])
+        source = expr.encode('utf-8')
+        parts = [source, bytes(-len(source) % 4)]
+        if dfa is None:
+            return Archive.RECORD.pack(len(source), 0, 0, 0, 0, -1,
+                                       -1) + b''.join(parts)
+        alphabet = dfa.alphabet
+        accepting = bytes(bytearray(dfa.accepting))
+        parts.extend([
+            array('i', alphabet.bounds).tobytes(),
+            array('i', alphabet.ids).tobytes(),
+            array('i', alphabet.representatives).tobytes(),
+            array('i', alphabet.table).tobytes(),
+            array('i', dfa.table).tobytes(),
+            accepting, bytes(-len(accepting) % 4)])
+        return Archive.RECORD.pack(
+            len(source), len(alphabet.bounds), alphabet.size,
+            len(alphabet.table), len(dfa.accepting), dfa.dead,
+            dfa.universal) + b''.join(parts)
 
     @staticmethod
-    def concat(nfa1, nfa2):
+    def load(path):
         '''
-        Concatenation
+        Maps the archive at `path` into memory. Raises ValueError if the
+        file is not an archive of this version or fails its checksum.
         '''
-        start_state = nfa1.start_state
-        accept_states = nfa2.accept_states
-        for accept_state in nfa1.accept_states:
-            accept_state.is_match = False
-            accept_state.out1 = Edge(NFA.epsilon(), nfa2.start_state)
-        return NFA(start_state, accept_states)
+        with open(path, 'rb') as stream:
+            mapping = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return Archive.from_buffer(mapping, mapping)
+        except Exception:
+            mapping.close()
+            raise
 
     @staticmethod
-    def union(nfa1, nfa2):
+    def from_buffer(buffer, mapping=None):
         '''
-        Union
+        Returns the archive held in the bytes-like object `buffer`,
+        whose tables are views into it rather than copies.
         '''
-        edge1 = Edge(NFA.epsilon(), nfa1.start_state)
-        edge2 = Edge(NFA.epsilon(), nfa2.start_state)
-        start_state = State(out1=edge1, out2=edge2, is_match=False)
-        return NFA(start_state, nfa1.accept_states + nfa2.accept_states)
+        data = memoryview(buffer)
+        if len(data) < Archive.HEADER.size:
+            raise ValueError('not a regex archive')
+        magic, version, little, flags, count, checksum = \
+            Archive.HEADER.unpack_from(data)
+        if magic != Archive.MAGIC:
+            raise ValueError('not a regex archive')
+        if version != Archive.VERSION:
+            raise ValueError('unsupported archive version {version}'.format(
+                version=version))
+        if little != (sys.byteorder == 'little'):
+            raise ValueError('archive was written with another byte order')
+        if zlib.crc32(data[Archive.HEADER.size:]) != checksum:
+            raise ValueError('archive checksum mismatch')
 
-    @staticmethod
-    def star(nfa):
+        exprs = []
+        dfas = []
+        offset = Archive.HEADER.size
+        for index in range(count):
+            fields = Archive.RECORD.unpack_from(data, offset)
+            offset += Archive.RECORD.size
+            (source_length, bounds, size, table, states, dead,
+             universal) = fields
+            exprs.append(str(data[offset:offset + source_length], 'utf-8'))
+            offset += source_length + (-source_length % 4)
+            if not states:
+                dfas.append(None)
+                continue
+
+            tables = []
+            for length in (bounds, bounds, size, table, states * size):
+                tables.append(data[offset:offset + 4 * length].cast('i'))
+                offset += 4 * length
+            accepting = data[offset:offset + states]
+            offset += states + (-states % 4)
+            bounds, ids, representatives, table, transitions = tables
+            alphabet = Alphabet.from_tables(bounds, ids, table,
+                                            representatives)
+            dfas.append(MinimalDFA(alphabet, transitions, accepting, dead,
+                                   universal))
+
+        return Archive(data, exprs, dfas, bool(flags & Archive.BINARY),
+                       mapping)
+
+    def __len__(self):
+        return len(self.exprs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
         '''
-        "*": zero or more
+        Releases the archive's views and memory map. Neither its patterns
+        nor the DFAs taken from `dfas`, whose tables are views of the
+        map, can be matched afterwards. If other views of the map are
+        still held, the archive is closed all the same and BufferError
+        is raised; the map is then closed once they are released.
         '''
-        edge = Edge(NFA.epsilon(), nfa.start_state)
-        # new start state uses out2 to connect to original machine, so
-        # out1 can be written to by a concatenation operation
-        new_start_state = State(out2=edge, is_match=True)
-        for accept_state in nfa.accept_states:
-            accept_state.out2 = Edge(NFA.epsilon(), nfa.start_state)
-        new_accept_states = nfa.accept_states
-        new_accept_states.append(new_start_state)
-        return NFA(new_start_state, new_accept_states)
+        dfas, self.dfas = self.dfas, []
+        views = [self.data]
+        for dfa in dfas:
+            if dfa is not None:
+                alphabet = dfa.alphabet
+                views.extend((alphabet.bounds, alphabet.ids, alphabet.table,
+                              alphabet.representatives, dfa.table,
+                              dfa.accepting))
+        mapping, self.mapping = self.mapping, None
+        for view in views:
+            view.release()
+        if mapping is not None:
+            mapping.close()
 
-    @staticmethod
-    def question(nfa):
+    def regex(self, index):
         '''
-        "?": zero or one
+        Returns the pattern at `index` compiled into a Regex, for the
+        operations the stored DFA cannot do, such as searching.
         '''
-        edge = Edge(NFA.epsilon(), nfa.start_state)
-        new_start_state = State(out2=edge, is_match=True)
-        new_accept_states = nfa.accept_states
-        new_accept_states.append(new_start_state)
-        return NFA(new_start_state, new_accept_states)
+        if index not in self.regexes:
+            self.regexes[index] = Regex(self.exprs[index],
+                                        binary=self.binary)
+        return self.regexes[index]
 
-    @staticmethod
-    def plus(nfa):
+    def test(self, index, string):
         '''
-        "+": one or more
+        Returns True if the pattern at `index` matches `string`.
         '''
-        edge = Edge(NFA.epsilon(), nfa.start_state)
-        new_start_state = State(out2=edge, is_match=False)
-        for accept_state in nfa.accept_states:
-            accept_state.out2 = Edge(NFA.epsilon(), nfa.start_state)
-        return NFA(new_start_state, nfa.accept_states)
+        check_type(string, self.binary)
+        if self.dfas[index] is None:
+            return self.regex(index).test(string)
+        return self.dfas[index].simulate(string)
 
-    @staticmethod
-    def find_active_states(active_states, visited_states=[]):
+    def matches(self, string):
         '''
-        Recursively finds all states linked to a set of starting states
-        by an epsilon edge (an edge whose `char` is empty string).
+        Returns the sorted indices of the patterns that match `string`.
         '''
-        def mark_as_visited(state):
-            visited_states.append(state)
+        return [index for index in range(len(self.exprs))
+                if self.test(index, string)]
 
-        def is_epsilon_edge(edge):
-            return edge and edge.token.value == ''
 
-        def is_active(state):
-            return state in active_states
+class LimitExceeded(Exception):
+    '''
+    Raised when matching a string goes over one of the bounds of the
+    Limits it was given.
+    '''
+
 
-        for state in active_states:
+class Limits(object):
+    '''
+    Bounds on the work a single call may do, for patterns and inputs
+    that cannot be trusted: the length of the input in characters, the
+    number of steps (each character read counts one step per NFA state,
+    or search thread, left active by it; one per character for a DFA),
+    and the wall time in seconds. None means unbounded.
+    '''
 
-            mark_as_visited(state)
+    __slots__ = ('max_chars', 'max_steps', 'timeout')
 
-            if (is_epsilon_edge(state.out1)
-                    and not is_active(state.out1.to_state)):
-                active_states.append(state.out1.to_state)
-            if (is_epsilon_edge(state.out2)
-                    and not is_active(state.out2.to_state)):
-                active_states.append(state.out2.to_state)
+    def __init__(self, max_chars=None, max_steps=None, timeout=None):
+        self.max_chars = max_chars
+        self.max_steps = max_steps
+        self.timeout = timeout
 
-        # if there are any active_states that have not been visited,
-        # follow their epsilon edges
-        unvisited_states = [state for state in active_states if state not
-                            in visited_states]
-        if len(unvisited_states) > 0:
-            return find_active_states(active_states, visited_states)
+    def start(self, length):
+        '''
+        Returns the Budget of a call on an input of `length` characters.
+        Raises LimitExceeded if the input is too long.
+        '''
+        if self.max_chars is not None and length > self.max_chars:
+            raise LimitExceeded(
+                'input of {length} characters is over the limit of '
+                '{max_chars}'.format(length=length, max_chars=self.max_chars))
+        return Budget(self)
 
-        return active_states
 
-    def simulate(self, string):
+class Budget(object):
+    '''
+    The work left to a call under some Limits, with the characters and
+    steps spent so far. The clock is only read every INTERVAL
+    characters.
+    '''
+
+    __slots__ = ('limits', 'chars', 'steps', 'deadline', 'unchecked')
+
+    INTERVAL = 1024
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.chars = 0
+        self.steps = 0
+        self.deadline = None
+        if limits.timeout is not None:
+            self.deadline = time.monotonic() + limits.timeout
+        self.unchecked = 0
+
+    def spend(self, chars, steps):
         '''
-        Starting from self.start_state, simulates the NFA.
-        Returns True if the NFA accepts the string, otherwise False.
+        Charges `chars` characters and `steps` steps, and raises
+        LimitExceeded if that goes over the limits.
         '''
-        active_states = NFA.find_active_states([self.start_state])
+        self.chars += chars
+        self.steps += steps
+        max_steps = self.limits.max_steps
+        if max_steps is not None and self.steps > max_steps:
+            raise LimitExceeded('over the limit of {max_steps} steps'.format(
+                max_steps=max_steps))
+        if self.deadline is None:
+            return
+        self.unchecked += chars
+        if self.unchecked >= Budget.INTERVAL:
+            self.unchecked = 0
+            if time.monotonic() > self.deadline:
+                raise LimitExceeded('over the time limit of {timeout} '
+                                    'seconds'.format(
+                                        timeout=self.limits.timeout))
+
 
-        for c in string:
-            next_states = []
-            for state in active_states:
-                # NOTE should this logic be in Edge?
-                if state.out1 and c in state.out1.token.value:
-                    next_states.append(state.out1.to_state)
-                if state.out2 and c in state.out2.token.value:
-                    next_states.append(state.out2.to_state)
+class Stats(object):
+    '''
+    Counters describing the work done to match a Regex: how many calls
+    were answered by each engine, how many characters were read, and
+    for NFA simulation how large the active state sets grew and how many
+    epsilon closures were merged into them; for a lazy DFA, how many
+    transitions were found in its cache and how many had to be built.
+    '''
 
-            active_states = NFA.find_active_states(next_states)
+    __slots__ = ('states', 'calls', 'chars', 'steps', 'active_states',
+                 'peak_active_states', 'closure_expansions', 'dfa_hits',
+                 'dfa_misses', 'engines')
 
-        for state in active_states:
-            if state.is_match:
-                return True
+    def __init__(self, states):
+        self.states = states
+        self.calls = 0
+        self.chars = 0
+        self.steps = 0
+        # summed over steps, for the average
+        self.active_states = 0
+        self.peak_active_states = 0
+        self.closure_expansions = 0
+        self.dfa_hits = 0
+        self.dfa_misses = 0
+        self.engines = {}
 
-        return False
+    def add(self, other):
+        '''
+        Adds the counters of `other` to these.
+        '''
+        self.calls += other.calls
+        self.chars += other.chars
+        self.steps += other.steps
+        self.active_states += other.active_states
+        self.peak_active_states = max(self.peak_active_states,
+                                      other.peak_active_states)
+        self.closure_expansions += other.closure_expansions
+        self.dfa_hits += other.dfa_hits
+        self.dfa_misses += other.dfa_misses
+        for engine, calls in other.engines.items():
+            self.engines[engine] = self.engines.get(engine, 0) + calls
 
+    def as_dict(self):
+        info = cache.info()
+        return {
+            'states': self.states,
+            'calls': self.calls,
+            'chars': self.chars,
+            'steps': self.steps,
+            'peak_active_states': self.peak_active_states,
+            'average_active_states': (self.active_states / self.steps
+                                      if self.steps else 0.0),
+            'closure_expansions': self.closure_expansions,
+            'dfa_hits': self.dfa_hits,
+            'dfa_misses': self.dfa_misses,
+            'cache_hits': info['hits'],
+            'cache_misses': info['misses'],
+            'engines': dict(self.engines),
+        }
 
-class State(object):
+
+class Match(object):
     '''
-    Each state is a node defined by its out edges. A state may be an
-    accept state or not.
+    The span of a string matched by Regex.search or Regex.finditer.
     '''
 
-    def __init__(self, out1=None, out2=None, is_match=False):
-        self.out1 = out1
-        self.out2 = out2
-        self.is_match = is_match
+    __slots__ = ('string', 'start', 'end')
 
+    def __init__(self, string, start, end):
+        self.string = string
+        self.start = start
+        self.end = end
 
-class Edge(object):
+    def group(self):
+        return self.string[self.start:self.end]
+
+    def span(self):
+        return (self.start, self.end)
+
+    def __str__(self):
+        return 'Match({start}, {end}, {group!r})'.format(
+            start=self.start,
+            end=self.end,
+            group=self.group()
+        )
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Matcher(object):
     '''
-    An edge has a character (which may be the empty string) and a target
-    state (which may be None in the case of dangling edges).
+    Matches a Program against input that arrives in chunks, such as the
+    blocks of a file or the data read from a socket, carrying the active
+    states across chunk boundaries so the input never has to be held in
+    memory at once.
+
+    Chunks are strings, or bytes-like objects for a binary Regex.
+
+    A testing matcher decides whether the whole input matches: `feed`
+    returns an empty list and `finish` returns True or False. A
+    searching matcher finds the same non-overlapping leftmost-longest
+    matches as Regex.finditer: `feed` and `finish` return the (start,
+    end) offsets of the matches completed so far. Only the input that a
+    match still in progress may need to rescan is buffered.
     '''
 
-    def __init__(self, token, to_state=None):
-        self.to_state = to_state
-        self.token = token
+    def __init__(self, program, search=False, dfa=None, binary=False):
+        self.program = program
+        self.search = search
+        self.binary = binary
+        self.dfa = None
+        if dfa is not None and dfa.flushes <= dfa.max_flushes:
+            self.dfa = dfa
+        self.finished = False
+        if not search:
+            if self.dfa:
+                self.state = self.dfa.start_state
+            else:
+                self.state = program.start_states
+            return
 
+        # offset of the next character to read, and of the first
+        # character held in the buffer
+        self.index = 0
+        self.base = 0
+        self.buffer = b'' if binary else ''
+        # offset from which the next match may start
+        self.pos = 0
+        self.threads = {}
+        self.match = None
 
-def main():
-    if len(sys.argv) > 2:
-        re = Regex(sys.argv[1])
-        for word in sys.argv[2:]:
-            if re.test(word):
-                print(word)
-    else:
-        raise Exception('Please provide a regular expression and at \
-                        least one string to test')
+    def feed(self, chunk):
+        '''
+        Consumes the next chunk of input.
+        '''
+        if self.finished:
+            raise ValueError('Matcher is finished')
+        check_type(chunk, self.binary)
+
+        if not self.search:
+            if self.dfa:
+                self.state = self.dfa.run(self.state, iter_codes(chunk))
+            else:
+                step = self.program.step
+                state = self.state
+                for code in iter_codes(chunk):
+                    state = step(state, code)
+                self.state = state
+            return []
+
+        if self.binary:
+            self.buffer += bytes(chunk)
+        else:
+            self.buffer += chunk
+        return self.scan(False)
+
+    def finish(self):
+        '''
+        Marks the end of the input.
+        '''
+        if self.finished:
+            raise ValueError('Matcher is finished')
+        self.finished = True
+
+        if not self.search:
+            if self.dfa:
+                return self.state.is_match
+            return self.program.is_match(self.state)
+
+        return self.scan(True)
+
+    async def feed_reader(self, reader, size=None, encoding='utf-8'):
+        '''
+        Feeds everything read from the asyncio.StreamReader `reader` up
+        to its end, reading at most `size` bytes (CHUNK_SIZE by default)
+        at a time and yielding to the event loop after each chunk.
+        Unless the matcher is binary, the data is decoded with
+        `encoding`. Returns the spans of the matches completed, as `feed`
+        does; `finish` is left to the caller.
+        '''
+        size = size or CHUNK_SIZE
+        decoder = None
+        if not self.binary:
+            decoder = codecs.getincrementaldecoder(encoding)()
+        found = []
+        while True:
+            chunk = await reader.read(size)
+            if decoder is not None:
+                chunk = decoder.decode(chunk)
+            if chunk:
+                found.extend(self.feed(chunk))
+            if reader.at_eof():
+                break
+            await asyncio.sleep(0)
+        if decoder is not None:
+            # flush whatever the decoder still holds
+            tail = decoder.decode(b'', True)
+            if tail:
+                found.extend(self.feed(tail))
+        return found
+
+    def scan(self, final):
+        '''
+        Runs the search as far as the buffered input allows, following
+        Program.search, and returns the spans of the matches completed.
+        '''
+        program = self.program
+        found = []
+        while True:
+            if self.match is None and self.index >= self.pos:
+                for state_id in program.start_states:
+                    self.threads.setdefault(state_id, self.index)
+
+            for state_id, start in self.threads.items():
+                if (program.ops[state_id] == OP_MATCH
+                        and (self.match is None or start <= self.match[0])):
+                    self.match = (start, self.index)
+            if self.match is not None:
+                self.threads = dict((state_id, start)
+                                    for state_id, start in self.threads.items()
+                                    if start <= self.match[0])
+
+            at_end = self.index == self.base + len(self.buffer)
+            if self.match is not None and (not self.threads
+                                           or (at_end and final)):
+                start, end = self.match
+                found.append(self.match)
+                self.match = None
+                self.threads = {}
+                self.pos = end if end > start else end + 1
+                # resume right after the match
+                self.index = end
+                continue
+
+            if at_end:
+                break
+
+            code = self.buffer[self.index - self.base]
+            if isinstance(code, str):
+                code = ord(code)
+            self.threads = program.step_threads(self.threads, code)
+            self.index += 1
+
+        # keep only what may still be rescanned: input from the end of a
+        # pending match, or from the start of the oldest live thread
+        if self.match is not None:
+            keep = self.match[1]
+        elif self.threads:
+            keep = min(self.threads.values())
+        else:
+            keep = self.index
+        self.buffer = self.buffer[keep - self.base:]
+        self.base = keep
+
+        return found
+
+
+class LiteralInfo(object):
+    '''
+    What can be said about the literal strings matched by a regular
+    expression, computed from its postfix tokens by static methods that
+    mirror the constructions of Program.from_tokens. `exact` is the set
+    of strings the expression matches if it is small and finite, or
+    None; `prefix` and `suffix` are strings every match starts and ends
+    with; `required` is a tuple of strings one of which occurs in every
+    match, or None.
+
+    Strings are cut to MAX_LENGTH characters (prefixes at the end and
+    suffixes at the start), which keeps them valid, and exact sets over
+    MAX_EXACT strings are dropped, so analysis stays linear.
+    '''
+
+    __slots__ = ('exact', 'prefix', 'suffix', 'required')
+
+    MAX_EXACT = 64
+    MAX_LENGTH = 256
+
+    def __init__(self, exact=None, prefix='', suffix='', required=None):
+        if exact is not None and len(exact) == 1 and required is None:
+            # the common case of a fixed string, which is its own prefix,
+            # suffix and required string
+            string, = exact
+            if len(string) <= LiteralInfo.MAX_LENGTH:
+                self.exact = exact
+                self.prefix = self.suffix = string
+                self.required = (string,) if string else None
+                return
+        if exact is not None and (
+                len(exact) > LiteralInfo.MAX_EXACT
+                or any(len(s) > LiteralInfo.MAX_LENGTH for s in exact)):
+            exact = None
+        if exact is not None:
+            prefix = common_prefix(exact)
+            suffix = common_suffix(exact)
+            if '' not in exact:
+                required = LiteralInfo.best(required, tuple(sorted(exact)))
+        self.exact = exact
+        self.prefix = prefix[:LiteralInfo.MAX_LENGTH]
+        self.suffix = suffix[-LiteralInfo.MAX_LENGTH:]
+        if required is not None:
+            required = tuple(sorted(set(
+                literal[:LiteralInfo.MAX_LENGTH] for literal in required)))
+        self.required = LiteralInfo.best(
+            LiteralInfo.best(required, self.prefix and (self.prefix,)),
+            self.suffix and (self.suffix,))
+
+    @staticmethod
+    def best(required1, required2):
+        '''
+        Returns the more selective of two required alternatives: the
+        one whose shortest string is longest, then the one with fewer
+        strings.
+        '''
+        if not required1:
+            return required2 or None
+        if not required2 or required1 == required2:
+            return required1
+
+        def score(required):
+            return (min(len(literal) for literal in required),
+                    -len(required))
+
+        return required1 if score(required1) >= score(required2) else required2
+
+    @staticmethod
+    def from_tokens(tokens):
+        '''
+        Returns the LiteralInfo of the expression given as postfix
+        tokens.
+        '''
+        stack = []
+        # literal tokens are shared, so their infos can be too
+        literals = {}
+        for token in tokens:
+            if token.type == '|':
+                info1 = stack.pop()
+                info2 = stack.pop()
+                stack.append(LiteralInfo.union(info1, info2))
+            elif token.type == '*':
+                stack.pop()
+                stack.append(LiteralInfo())
+            elif token.type == '+':
+                stack.append(LiteralInfo.plus(stack.pop()))
+            elif token.type == '?':
+                stack.append(LiteralInfo.question(stack.pop()))
+            elif token.type == '.':
+                info2 = stack.pop()
+                info1 = stack.pop()
+                stack.append(LiteralInfo.concat(info1, info2))
+            else:
+                if id(token) not in literals:
+                    literals[id(token)] = LiteralInfo.literal(token)
+                stack.append(literals[id(token)])
+
+        return stack.pop()
+
+    @staticmethod
+    def literal(token):
+        if token.value == '':
+            return LiteralInfo(exact=frozenset(['']))
+        if len(token.chars) > LiteralInfo.MAX_EXACT:
+            return LiteralInfo()
+        return LiteralInfo(exact=frozenset(
+            chr(code) for first, last in token.chars.ranges
+            for code in range(first, last + 1)))
+
+    @staticmethod
+    def concat(info1, info2):
+        if (info1.exact is not None and info2.exact is not None
+                and len(info1.exact) * len(info2.exact)
+                <= LiteralInfo.MAX_EXACT):
+            return LiteralInfo(exact=frozenset(
+                s1 + s2 for s1 in info1.exact for s2 in info2.exact))
+
+        if info1.exact is not None:
+            prefix = common_prefix([s + info2.prefix for s in info1.exact])
+        else:
+            prefix = info1.prefix
+        if info2.exact is not None:
+            suffix = common_suffix([info1.suffix + s for s in info2.exact])
+        else:
+            suffix = info2.suffix
+        # the end of the first part and the start of the second meet
+        junction = info1.suffix + info2.prefix
+        required = LiteralInfo.best(
+            LiteralInfo.best(info1.required, info2.required),
+            junction and (junction,))
+        return LiteralInfo(prefix=prefix, suffix=suffix, required=required)
+
+    @staticmethod
+    def union(info1, info2):
+        if info1.exact is not None and info2.exact is not None:
+            return LiteralInfo(exact=info1.exact | info2.exact)
+
+        required = None
+        if (info1.required and info2.required
+                and len(info1.required) + len(info2.required)
+                <= LiteralInfo.MAX_EXACT):
+            required = info1.required + info2.required
+        return LiteralInfo(
+            prefix=common_prefix([info1.prefix, info2.prefix]),
+            suffix=common_suffix([info1.suffix, info2.suffix]),
+            required=required)
+
+    @staticmethod
+    def question(info):
+        if info.exact is not None:
+            return LiteralInfo(exact=info.exact | frozenset(['']))
+        return LiteralInfo()
+
+    @staticmethod
+    def plus(info):
+        return LiteralInfo(prefix=info.prefix, suffix=info.suffix,
+                           required=info.required)
+
+
+class Prefilter(object):
+    '''
+    Cheap tests run before simulating a program, built from the
+    LiteralInfo of the pattern: a string can only match if it starts
+    with `prefix`, ends with `suffix` and contains one of `required`.
+    They use str and bytes methods implemented in C, so most strings
+    that cannot match are rejected without running the automaton. For a
+    binary pattern the literals are UTF-8 encoded, and only bytes and
+    bytearray inputs are prefiltered.
+    '''
+
+    __slots__ = ('prefix', 'suffix', 'required', 'types')
+
+    def __init__(self, prefix, suffix, required, binary=False):
+        if binary:
+            prefix = prefix.encode('utf-8')
+            suffix = suffix.encode('utf-8')
+            required = tuple(literal.encode('utf-8') for literal in required)
+            self.types = (bytes, bytearray)
+        else:
+            self.types = (str,)
+        self.prefix = prefix
+        self.suffix = suffix
+        self.required = required
+
+    @staticmethod
+    def from_tokens(tokens, binary=False):
+        '''
+        Returns a Prefilter for the pattern given as postfix tokens, or
+        None if no literal is required.
+        '''
+        info = LiteralInfo.from_tokens(tokens)
+        required = info.required or ()
+        # the prefix and suffix are checked directly
+        if required in ((info.prefix,), (info.suffix,)):
+            required = ()
+        if not (info.prefix or info.suffix or required):
+            return None
+        return Prefilter(info.prefix, info.suffix, required, binary)
+
+    def rejects(self, string):
+        '''
+        Returns True if `string` certainly does not match as a whole.
+        '''
+        if not isinstance(string, self.types):
+            return False
+        if not string.startswith(self.prefix):
+            return True
+        if not string.endswith(self.suffix):
+            return True
+        if self.required:
+            for literal in self.required:
+                if literal in string:
+                    return False
+            return True
+        return False
+
+    def find_start(self, string, pos):
+        '''
+        Returns the first offset at or after `pos` at which a match in
+        `string` may start, or -1 if there is none.
+        '''
+        if not isinstance(string, self.types):
+            return pos
+        if self.required and not any(
+                string.find(literal, pos) != -1 for literal in self.required):
+            return -1
+        if self.prefix:
+            return string.find(self.prefix, pos)
+        return pos
+
+
+class FastPath(object):
+    '''
+    A test for patterns of a few common shapes that decides whether a
+    string matches with str, set and frozenset operations implemented in
+    C, without simulating the automaton:
+
+    - 'strings': a fixed string or an alternation of fixed strings, such
+      as `hello` or `a|b|c`, is a frozenset lookup;
+    - 'repeat': a single character class under `*`, `+` or `?`, such as
+      `[a-z]+`, is a subset test of the string against the class;
+    - 'classes': a sequence of character classes, such as
+      `[A-Z][0-9][0-9]`, checks each character against its class.
+
+    The shape is found by evaluating the postfix tokens on a stack of
+    shapes, as Program.from_tokens does with NFAs. A 'strings' shape
+    also keeps a bound on the total length of its strings, and sets of
+    more than MAX_STRINGS strings or MAX_LENGTH characters are dropped,
+    so that a pattern like `a{0,1000}` does not build and keep a
+    quadratic number of characters. Classes with more than MAX_CLASS
+    characters are not expanded into sets. For a binary pattern only
+    bytes inputs take the fast path, and classes must be ASCII so that
+    each character is one byte.
+    '''
+
+    __slots__ = ('shape', 'test', 'types')
+
+    MAX_STRINGS = 10000
+    MAX_LENGTH = 100000
+    MAX_CLASS = 1024
+
+    def __init__(self, shape, test, types):
+        self.shape = shape
+        self.test = test
+        self.types = types
+
+    @staticmethod
+    def from_tokens(tokens, binary=False):
+        '''
+        Returns a FastPath for the pattern given as postfix tokens, or
+        None if the pattern has none of the shapes.
+        '''
+        stack = []
+        literals = {}
+        for token in tokens:
+            if token.type == '|':
+                shape2 = FastPath.as_strings(stack.pop())
+                shape1 = FastPath.as_strings(stack.pop())
+                shape = None
+                if (shape1 and shape2 and len(shape1[1]) + len(shape2[1])
+                        <= FastPath.MAX_STRINGS
+                        and shape1[2] + shape2[2] <= FastPath.MAX_LENGTH):
+                    # add the smaller set to the larger; sets made by a
+                    # union belong to it alone and are added to in place,
+                    # so a long alternation is not copied at every step
+                    strings1, strings2 = shape1[1], shape2[1]
+                    if len(strings1) < len(strings2):
+                        strings1, strings2 = strings2, strings1
+                    if not isinstance(strings1, set):
+                        strings1 = set(strings1)
+                    strings1 |= strings2
+                    # strings found in both are counted twice, which only
+                    # makes the count an upper bound
+                    shape = ('strings', strings1, shape1[2] + shape2[2])
+                stack.append(shape)
+            elif token.type in '*+?':
+                shape = stack.pop()
+                chars = FastPath.as_class(shape)
+                if token.type == '?' and shape and shape[0] == 'strings':
+                    stack.append(('strings', shape[1] | frozenset(['']),
+                                  shape[2]))
+                elif chars is not None:
+                    stack.append(('repeat', chars, token.type))
+                else:
+                    stack.append(None)
+            elif token.type == '.':
+                shape2 = stack.pop()
+                shape1 = stack.pop()
+                stack.append(FastPath.concat(shape1, shape2))
+            elif id(token) in literals:
+                stack.append(literals[id(token)])
+            else:
+                if len(token.chars) == 1 or token.value == '':
+                    shape = ('strings', frozenset([''.join(
+                        chr(first) for first, last in token.chars.ranges)]),
+                        len(token.chars))
+                else:
+                    shape = ('classes', (token.chars,))
+                literals[id(token)] = shape
+                stack.append(shape)
+
+        return FastPath.build(stack.pop(), binary)
+
+    @staticmethod
+    def as_strings(shape):
+        '''
+        Returns a 'classes' shape of one small class as a 'strings'
+        shape, and other shapes unchanged.
+        '''
+        if (shape and shape[0] == 'classes' and len(shape[1]) == 1
+                and len(shape[1][0]) <= FastPath.MAX_CLASS):
+            chars = shape[1][0]
+            return ('strings', frozenset(FastPath.expand(chars)), len(chars))
+        if shape and shape[0] == 'strings':
+            return shape
+        return None
+
+    @staticmethod
+    def as_class(shape):
+        '''
+        Returns the CharClass of a shape that matches exactly one
+        character, or None.
+        '''
+        if shape and shape[0] == 'classes' and len(shape[1]) == 1:
+            return shape[1][0]
+        if (shape and shape[0] == 'strings'
+                and all(len(string) == 1 for string in shape[1])):
+            return CharClass((ord(string), ord(string))
+                             for string in shape[1])
+        return None
+
+    @staticmethod
+    def as_classes(shape):
+        '''
+        Returns the classes of a shape that matches a fixed sequence of
+        classes, or None.
+        '''
+        if shape and shape[0] == 'classes':
+            return shape[1]
+        if shape and shape[0] == 'strings' and len(shape[1]) == 1:
+            string, = shape[1]
+            return tuple(CharClass([(ord(c), ord(c))]) for c in string)
+        chars = FastPath.as_class(shape)
+        if chars is not None:
+            return (chars,)
+        return None
+
+    @staticmethod
+    def concat(shape1, shape2):
+        if (shape1 and shape2 and shape1[0] == shape2[0] == 'strings'
+                and len(shape1[1]) * len(shape2[1]) <= FastPath.MAX_STRINGS):
+            # the length of every string of each set is added to every
+            # string of the other
+            length = (shape1[2] * len(shape2[1])
+                      + shape2[2] * len(shape1[1]))
+            if length > FastPath.MAX_LENGTH:
+                return None
+            strings = frozenset(string1 + string2
+                                for string1 in shape1[1]
+                                for string2 in shape2[1])
+            if len(strings) < len(shape1[1]) * len(shape2[1]):
+                length = sum(map(len, strings))
+            return ('strings', strings, length)
+        classes1 = FastPath.as_classes(shape1)
+        classes2 = FastPath.as_classes(shape2)
+        if classes1 is not None and classes2 is not None:
+            return ('classes', classes1 + classes2)
+        return None
+
+    @staticmethod
+    def expand(chars):
+        return [chr(code) for first, last in chars.ranges
+                for code in range(first, last + 1)]
+
+    @staticmethod
+    def build(shape, binary):
+        if shape is None:
+            return None
+
+        if binary:
+            types = (bytes,)
+            if shape[0] == 'strings':
+                return FastPath('strings', frozenset(
+                    string.encode('utf-8') for string in shape[1]
+                ).__contains__, types)
+            classes = shape[1] if shape[0] == 'classes' else (shape[1],)
+            if any(chars.ranges and chars.ranges[-1][1] >= 0x80
+                   for chars in classes):
+                return None
+
+            def charset(chars):
+                return frozenset(ord(c) for c in FastPath.expand(chars))
+        else:
+            types = (str,)
+            if shape[0] == 'strings':
+                return FastPath('strings', frozenset(shape[1]).__contains__,
+                                types)
+
+            def charset(chars):
+                if len(chars) > FastPath.MAX_CLASS:
+                    return chars
+                return frozenset(FastPath.expand(chars))
+
+        if shape[0] == 'classes':
+            charsets = [charset(chars) for chars in shape[1]]
+            length = len(charsets)
+
+            def test(string):
+                return len(string) == length and all(
+                    c in chars for c, chars in zip(string, charsets))
+
+            return FastPath('classes', test, types)
+
+        chars = charset(shape[1])
+        if isinstance(chars, CharClass):
+            def contains_all(string):
+                return all(map(chars.__contains__, string))
+        else:
+            contains_all = chars.issuperset
+
+        if shape[2] == '*':
+            test = contains_all
+        elif shape[2] == '+':
+            def test(string):
+                return len(string) > 0 and contains_all(string)
+        else:
+            def test(string):
+                return len(string) <= 1 and contains_all(string)
+
+        return FastPath('repeat', test, types)
+
+
+class NFA(object):
+    '''
+    An NFA is a collection of linked state structures with a start state
+    and a set of accept states, whose edges are labeled with a character
+    class or with the empty string. A Regex does not match through its
+    NFA: its pattern is compiled straight into the tables of a Program,
+    and the NFA is a view of those tables as State and Edge objects,
+    built by from_program when it is asked for, in which states[i] is
+    the state with id i. Simulating it simulates the program.
+    '''
+
+    def __init__(self, start_state, accept_states, states=(), program=None):
+        self.start_state = start_state
+        self.accept_states = accept_states
+        self.states = list(states)
+        self.program = program
+
+    @staticmethod
+    def from_program(program):
+        '''
+        Returns the graph of `program`: a State for each of its states,
+        with the same id, and an Edge for each of its edges. Character
+        edges are labeled with a literal token of their character or
+        class, and epsilon edges with EPSILON.
+        '''
+        states = [State(is_match=op == OP_MATCH) for op in program.ops]
+        for state_id, state in enumerate(states):
+            state.id = state_id
+
+        def target(state_id):
+            return states[state_id] if state_id != -1 else None
+
+        for state_id, op in enumerate(program.ops):
+            state = states[state_id]
+            out1 = program.out1[state_id]
+            out2 = program.out2[state_id]
+            if op == OP_CHAR or op == OP_CLASS:
+                if op == OP_CHAR:
+                    code = program.args[state_id]
+                    chars = CharClass([(code, code)])
+                else:
+                    chars = program.classes[program.args[state_id]]
+                value = ''.join(
+                    chr(first) if first == last
+                    else '{first}-{last}'.format(first=chr(first),
+                                                 last=chr(last))
+                    for first, last in chars.ranges)
+                state.out1 = Edge(Token('literal', value, chars),
+                                  target(out1))
+                continue
+            if out1 != -1:
+                state.out1 = Edge(EPSILON, target(out1))
+            if out2 != -1:
+                state.out2 = Edge(EPSILON, target(out2))
+
+        return NFA(states[program.start],
+                   [state for state in states if state.is_match],
+                   states, program)
+
+    def simulate(self, string):
+        '''
+        Starting from self.start_state, simulates the NFA.
+        Returns True if the NFA accepts the string, otherwise False.
+        '''
+        return self.program.simulate(string)
+
+
+class Program(object):
+    '''
+    The flattened, compiled form of an NFA, made of parallel tables
+    indexed by state id. ops[i] is the opcode of state i: OP_CHAR and
+    OP_CLASS states have a single character edge leading to out1[i],
+    labeled with the character code args[i] or with the character class
+    classes[args[i]] respectively; OP_SPLIT states have epsilon edges
+    leading to out1[i] and out2[i], and OP_MATCH states are accept
+    states that may also have epsilon edges. A missing edge is -1.
+
+    The epsilon closure of the start state and of every state entered
+    by a character edge is precomputed as a frozenset of ids. Closures
+    leave out OP_SPLIT states, which are never the source of a
+    transition, so simulation only ever unions closures of states with
+    a character edge or accept states. The program's Alphabet groups the
+    characters its edges cannot tell apart.
+
+    A program merged from several others tags each accept state with the
+    index of the program it comes from in `tags`, which is otherwise
+    None.
+    '''
+
+    __slots__ = ('ops', 'out1', 'out2', 'args', 'classes', 'start', 'tags',
+                 'closures', 'start_states', 'alphabet')
+
+    def __init__(self, ops, out1, out2, args, classes, start, tags=None):
+        self.ops = ops
+        self.out1 = out1
+        self.out2 = out2
+        self.args = args
+        self.classes = classes
+        self.start = start
+        self.tags = tags
+
+        self.closures = [None] * len(ops)
+        scratch = SparseSet(len(ops))
+
+        def add_closure(state_id):
+            op = ops[state_id]
+            if op == OP_CHAR or op == OP_CLASS:
+                # no epsilon edges leave the state
+                self.closures[state_id] = frozenset([state_id])
+            elif (op == OP_SPLIT and out2[state_id] == -1
+                    and out1[state_id] != -1
+                    and ops[out1[state_id]] in (OP_CHAR, OP_CLASS)):
+                # the join of a concatenation
+                self.closures[state_id] = frozenset([out1[state_id]])
+            elif self.closures[state_id] is None:
+                scratch.clear()
+                self.find_active_states([state_id], scratch)
+                self.closures[state_id] = frozenset(
+                    active_id for active_id in scratch
+                    if ops[active_id] != OP_SPLIT)
+
+        add_closure(start)
+        for state_id, op in enumerate(ops):
+            if op == OP_CHAR or op == OP_CLASS:
+                add_closure(out1[state_id])
+
+        self.start_states = self.closures[start]
+
+        codes = set(args[state_id] for state_id, op in enumerate(ops)
+                    if op == OP_CHAR)
+        self.alphabet = Alphabet(
+            classes + [CharClass([(code, code)]) for code in sorted(codes)])
+
+    @staticmethod
+    def from_tokens(tokens, binary=False):
+        '''
+        Compiles an expression given as postfix tokens into a Program by
+        Thompson's construction: the tokens are evaluated on a stack of
+        NFA fragments, each a start state and a list of accept states,
+        with one constructor per regular operation. States are kept in
+        parallel lists rather than as objects: the character class on
+        the edge of each literal state, its two targets and whether it
+        accepts. Accept states always have a free first edge, which a
+        concatenation writes to. The states are then numbered depth
+        first from the start state, first edges first, and flattened
+        into the tables.
+        '''
+        # chars[i] is the class of the character edge out of state i, or
+        # None if its edges are epsilon edges
+        chars = []
+        targets1 = []
+        targets2 = []
+        is_match = []
+
+        def add_state(target1=-1, target2=-1, match=False, edge=None):
+            chars.append(edge)
+            targets1.append(target1)
+            targets2.append(target2)
+            is_match.append(match)
+            return len(chars) - 1
+
+        def literal(edge):
+            # a character edge labeled with the class `edge`, or an
+            # epsilon edge if it is None
+            accept_state = add_state(match=True)
+            return add_state(accept_state, edge=edge), [accept_state]
+
+        def concat(nfa1, nfa2):
+            for accept_state in nfa1[1]:
+                is_match[accept_state] = False
+                targets1[accept_state] = nfa2[0]
+            return nfa1[0], nfa2[1]
+
+        def union(nfa1, nfa2):
+            # extend the longer list, so that a long alternation is linear
+            accept_states1, accept_states2 = nfa1[1], nfa2[1]
+            if len(accept_states1) < len(accept_states2):
+                accept_states1, accept_states2 = accept_states2, accept_states1
+            accept_states1.extend(accept_states2)
+            return add_state(nfa1[0], nfa2[0]), accept_states1
+
+        def loop(nfa, start_is_match):
+            # '*' if the new start state accepts, '+' otherwise. The
+            # accept states loop back to the start through their second
+            # edge; those whose second edge an inner '*' or '?' already
+            # took are instead joined by an epsilon edge to one new
+            # accept state. The new start state also uses its second
+            # edge, so that a concatenation can write to its first.
+            accept_states = []
+            joined_state = None
+            for accept_state in nfa[1]:
+                if targets2[accept_state] == -1:
+                    accept_states.append(accept_state)
+                    continue
+                if joined_state is None:
+                    joined_state = add_state(match=True)
+                    accept_states.append(joined_state)
+                is_match[accept_state] = False
+                targets1[accept_state] = joined_state
+            for accept_state in accept_states:
+                targets2[accept_state] = nfa[0]
+            start_state = add_state(target2=nfa[0], match=start_is_match)
+            if start_is_match:
+                accept_states.append(start_state)
+            return start_state, accept_states
+
+        def utf8_literal(token):
+            # the UTF-8 encodings of the characters of a literal token: a
+            # union of concatenations of byte literals, with all single
+            # byte encodings sharing one literal
+            if token.value == '':
+                return literal(None)
+            single_byte_ranges = []
+            nfas = []
+            for first, last in token.chars.ranges:
+                for sequence in utf8_ranges(first, last):
+                    if len(sequence) == 1:
+                        single_byte_ranges.extend(sequence)
+                        continue
+                    nfa = literal(CharClass(sequence[:1]))
+                    for byte_range in sequence[1:]:
+                        nfa = concat(nfa, literal(CharClass([byte_range])))
+                    nfas.append(nfa)
+            if single_byte_ranges or not nfas:
+                nfas.insert(0, literal(CharClass(single_byte_ranges)))
+            nfa = nfas[0]
+            for other in nfas[1:]:
+                nfa = union(nfa, other)
+            return nfa
+
+        stack = []
+        for token in tokens:
+            if token.type == '|':
+                nfa1 = stack.pop()
+                nfa2 = stack.pop()
+                stack.append(union(nfa1, nfa2))
+            elif token.type == '*':
+                stack.append(loop(stack.pop(), True))
+            elif token.type == '+':
+                stack.append(loop(stack.pop(), False))
+            elif token.type == '?':
+                # a new accepting start state, skipping the fragment
+                nfa = stack.pop()
+                start_state = add_state(target2=nfa[0], match=True)
+                nfa[1].append(start_state)
+                stack.append((start_state, nfa[1]))
+            elif token.type == '.':
+                nfa2 = stack.pop()
+                nfa1 = stack.pop()
+                stack.append(concat(nfa1, nfa2))
+            elif binary:
+                stack.append(utf8_literal(token))
+            else:
+                stack.append(literal(token.chars if token.value else None))
+        start = stack.pop()[0]
+
+        # number the states depth first, out1 before out2
+        ids = [-1] * len(chars)
+        order = []
+        pending = [start]
+        while pending:
+            state = pending.pop()
+            if ids[state] != -1:
+                continue
+            ids[state] = len(order)
+            order.append(state)
+            for target in (targets2[state], targets1[state]):
+                if target != -1 and ids[target] == -1:
+                    pending.append(target)
+
+        ops = array('B')
+        out1 = array('i')
+        out2 = array('i')
+        args = array('i')
+        classes = []
+        class_ids = {}
+        for state in order:
+            edge = chars[state]
+            if edge is not None:
+                if len(edge.ranges) == 1 and len(edge) == 1:
+                    ops.append(OP_CHAR)
+                    args.append(edge.ranges[0][0])
+                else:
+                    if edge not in class_ids:
+                        class_ids[edge] = len(classes)
+                        classes.append(edge)
+                    ops.append(OP_CLASS)
+                    args.append(class_ids[edge])
+                out1.append(ids[targets1[state]])
+                out2.append(-1)
+            else:
+                ops.append(OP_MATCH if is_match[state] else OP_SPLIT)
+                args.append(0)
+                target1, target2 = targets1[state], targets2[state]
+                out1.append(ids[target1] if target1 != -1 else -1)
+                out2.append(ids[target2] if target2 != -1 else -1)
+
+        return Program(ops, out1, out2, args, classes, 0)
+
+    @staticmethod
+    def merge(programs):
+        '''
+        Returns a Program that runs `programs` side by side. Their tables
+        are concatenated, with state and class ids shifted, and a tree of
+        OP_SPLIT states fans out from a new start state to the start
+        state of each program, as a union does for two NFAs. Each
+        accept state is tagged with the index of its program.
+        '''
+        ops = array('B')
+        out1 = array('i')
+        out2 = array('i')
+        args = array('i')
+        tags = array('i')
+        classes = []
+        class_ids = {}
+
+        def shift(target, offset):
+            return target + offset if target != -1 else -1
+
+        starts = []
+        for index, program in enumerate(programs):
+            offset = len(ops)
+            starts.append(program.start + offset)
+            for state_id, op in enumerate(program.ops):
+                ops.append(op)
+                out1.append(shift(program.out1[state_id], offset))
+                out2.append(shift(program.out2[state_id], offset))
+                if op == OP_CLASS:
+                    chars = program.classes[program.args[state_id]]
+                    if chars not in class_ids:
+                        class_ids[chars] = len(classes)
+                        classes.append(chars)
+                    args.append(class_ids[chars])
+                else:
+                    args.append(program.args[state_id])
+                tags.append(index if op == OP_MATCH else -1)
+
+        def add_split(target1, target2):
+            ops.append(OP_SPLIT)
+            out1.append(target1)
+            out2.append(target2)
+            args.append(0)
+            tags.append(-1)
+            return len(ops) - 1
+
+        if not starts:
+            starts.append(add_split(-1, -1))
+        while len(starts) > 1:
+            starts = [add_split(starts[index], starts[index+1])
+                      if index + 1 < len(starts) else starts[index]
+                      for index in range(0, len(starts), 2)]
+
+        return Program(ops, out1, out2, args, classes, starts[0], tags)
+
+    def matching_tags(self, active_states):
+        '''
+        Returns the sorted tags of the accept states among the state ids
+        `active_states`.
+        '''
+        return sorted(set(self.tags[state_id] for state_id in active_states
+                          if self.ops[state_id] == OP_MATCH))
+
+    def find_active_states(self, state_ids, active_states):
+        '''
+        Adds the given state ids, and the ids of all states linked to
+        them by epsilon edges, to the SparseSet `active_states`.
+        '''
+        stack = list(state_ids)
+        while stack:
+            state_id = stack.pop()
+            if state_id in active_states:
+                continue
+            active_states.add(state_id)
+            op = self.ops[state_id]
+            if op == OP_SPLIT or op == OP_MATCH:
+                if self.out2[state_id] != -1:
+                    stack.append(self.out2[state_id])
+                if self.out1[state_id] != -1:
+                    stack.append(self.out1[state_id])
+
+        return active_states
+
+    def step(self, active_states, code):
+        '''
+        Returns the set of state ids active after reading the character
+        (or byte) `code` from the state ids `active_states`, as the union
+        of the precomputed closures of the states their matching edges
+        lead to.
+        '''
+        ops = self.ops
+        args = self.args
+        out1 = self.out1
+        closures = self.closures
+
+        next_states = set()
+        for state_id in active_states:
+            op = ops[state_id]
+            if op == OP_CHAR:
+                if args[state_id] == code:
+                    next_states |= closures[out1[state_id]]
+            elif op == OP_CLASS:
+                if self.classes[args[state_id]].includes(code):
+                    next_states |= closures[out1[state_id]]
+
+        return next_states
+
+    def record(self, string, stats):
+        '''
+        Simulates the program like `simulate`, adding the size of the
+        active state set at each step and the number of closures merged
+        into it to the counters of the Stats `stats`.
+        '''
+        ops = self.ops
+        args = self.args
+        out1 = self.out1
+        closures = self.closures
+
+        active_states = self.start_states
+        peak = len(active_states)
+        for code in iter_codes(string):
+            next_states = set()
+            for state_id in active_states:
+                op = ops[state_id]
+                if ((op == OP_CHAR and args[state_id] == code)
+                        or (op == OP_CLASS
+                            and self.classes[args[state_id]].includes(code))):
+                    next_states |= closures[out1[state_id]]
+                    stats.closure_expansions += 1
+            active_states = next_states
+            stats.chars += 1
+            stats.steps += 1
+            stats.active_states += len(active_states)
+            peak = max(peak, len(active_states))
+        stats.peak_active_states = max(stats.peak_active_states, peak)
+
+        return self.is_match(active_states)
+
+    def is_match(self, active_states):
+        '''
+        Returns True if any of the state ids `active_states` is an
+        accept state.
+        '''
+        for state_id in active_states:
+            if self.ops[state_id] == OP_MATCH:
+                return True
+
+        return False
+
+    def simulate(self, string):
+        '''
+        Returns True if the program accepts the string, otherwise False.
+        '''
+        active_states = self.start_states
+
+        for code in iter_codes(string):
+            active_states = self.step(active_states, code)
+            if not active_states:
+                return False
+
+        return self.is_match(active_states)
+
+    def run(self, active_states, string, budget):
+        '''
+        Returns the state ids active after reading `string` from
+        `active_states`, charging each character and the active states
+        it leaves to the Budget `budget`. Stops early if no state is
+        left active.
+        '''
+        for chunk in iter_slices(string, Budget.INTERVAL):
+            steps = 0
+            for code in iter_codes(chunk):
+                active_states = self.step(active_states, code)
+                steps += len(active_states)
+                if not active_states:
+                    break
+            budget.spend(len(chunk), steps)
+            if not active_states:
+                break
+
+        return active_states
+
+    def step_threads(self, threads, code):
+        '''
+        Like step, but for threads: `threads` maps the id of each active
+        state to the offset at which the thread that reached it started.
+        When two threads reach the same state only the one that started
+        first is kept, as in Pike's VM.
+        '''
+        ops = self.ops
+        args = self.args
+        out1 = self.out1
+        closures = self.closures
+
+        next_threads = {}
+        for state_id, start in threads.items():
+            op = ops[state_id]
+            if ((op == OP_CHAR and args[state_id] == code)
+                    or (op == OP_CLASS
+                        and self.classes[args[state_id]].includes(code))):
+                for next_id in closures[out1[state_id]]:
+                    if start < next_threads.get(next_id, start + 1):
+                        next_threads[next_id] = start
+
+        return next_threads
+
+    def search(self, string, pos=0, budget=None):
+        '''
+        Returns the (start, end) span of the leftmost-longest match in
+        `string` at or after `pos`, or None, in a single pass. Each
+        character read and its live threads are charged to `budget`, if
+        given.
+
+        The search is unanchored: it behaves as if the start state had a
+        self-loop on every character, by starting a new thread at each
+        offset. Once a match is found no more threads are started, and
+        threads that started after the match are dropped; the others run
+        until they die so the longest match from the leftmost start wins.
+        '''
+        codes = as_codes(string)
+        match = None
+        threads = {}
+        # like re, a start outside the string is moved to its nearest end
+        index = max(0, min(pos, len(codes)))
+        while True:
+            if match is None:
+                for state_id in self.start_states:
+                    threads.setdefault(state_id, index)
+
+            for state_id, start in threads.items():
+                if (self.ops[state_id] == OP_MATCH
+                        and (match is None or start <= match[0])):
+                    match = (start, index)
+            if match is not None:
+                threads = dict((state_id, start)
+                               for state_id, start in threads.items()
+                               if start <= match[0])
+
+            if index == len(codes) or (match is not None and not threads):
+                return match
+
+            code = codes[index]
+            if isinstance(code, str):
+                code = ord(code)
+            threads = self.step_threads(threads, code)
+            index += 1
+            if budget is not None:
+                budget.spend(1, len(threads))
+
+
+class Alphabet(object):
+    '''
+    Partitions all characters into the classes of characters a Program
+    cannot tell apart: two characters are equivalent if every character
+    and character class of the program contains both or neither. A
+    character is mapped to its class id through a table if it is below
+    TABLE_SIZE and by binary search over the class boundaries otherwise,
+    so automata built from the program can key their transitions on a
+    handful of class ids rather than on characters.
+    '''
+
+    __slots__ = ('bounds', 'ids', 'table', 'representatives', 'size')
+
+    TABLE_SIZE = 256
+
+    def __init__(self, charsets):
+        # equal charsets share a signature, so only look at each once
+        charsets = list(dict.fromkeys(charsets))
+        bounds = set([0])
+        for chars in charsets:
+            for first, last in chars.ranges:
+                bounds.add(first)
+                if last < sys.maxunicode:
+                    bounds.add(last + 1)
+        self.bounds = sorted(bounds)
+
+        # the charsets containing each interval between two bounds
+        signatures = [[] for bound in self.bounds]
+        for index, chars in enumerate(charsets):
+            for first, last in chars.ranges:
+                for interval in range(bisect_right(self.bounds, first) - 1,
+                                      bisect_right(self.bounds, last)):
+                    signatures[interval].append(index)
+
+        class_ids = {}
+        self.ids = array('i')
+        self.representatives = []
+        for bound, signature in zip(self.bounds, signatures):
+            signature = tuple(signature)
+            if signature not in class_ids:
+                class_ids[signature] = len(class_ids)
+                self.representatives.append(bound)
+            self.ids.append(class_ids[signature])
+        self.size = len(class_ids)
+
+        self.table = array('i', [
+            self.ids[bisect_right(self.bounds, code) - 1]
+            for code in range(Alphabet.TABLE_SIZE)])
+
+    @staticmethod
+    def from_tables(bounds, ids, table, representatives):
+        '''
+        Returns an Alphabet made of previously computed tables, such as
+        views into an Archive, without partitioning any charsets.
+        '''
+        alphabet = Alphabet.__new__(Alphabet)
+        alphabet.bounds = bounds
+        alphabet.ids = ids
+        alphabet.table = table
+        alphabet.representatives = representatives
+        alphabet.size = len(representatives)
+        return alphabet
+
+    def classify(self, code):
+        '''
+        Returns the id of the class of the character (or byte) `code`.
+        '''
+        if code < Alphabet.TABLE_SIZE:
+            return self.table[code]
+        return self.ids[bisect_right(self.bounds, code) - 1]
+
+
+class SparseSet(object):
+    '''
+    A set of integers in range(size) with constant time add, membership
+    test and clear, iterated in insertion order (Briggs and Torczon).
+    Cox uses the same structure for the thread lists of his NFA
+    simulations; here it collects epsilon closures at compile time.
+    '''
+
+    __slots__ = ('dense', 'sparse', 'size')
+
+    def __init__(self, size):
+        self.dense = [0] * size
+        self.sparse = [0] * size
+        self.size = 0
+
+    def __contains__(self, value):
+        index = self.sparse[value]
+        return index < self.size and self.dense[index] == value
+
+    def __iter__(self):
+        return iter(self.dense[:self.size])
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value):
+        if value not in self:
+            self.dense[self.size] = value
+            self.sparse[value] = self.size
+            self.size += 1
+
+    def clear(self):
+        self.size = 0
+
+
+class DFA(object):
+    '''
+    A DFA built lazily from a compiled NFA Program by subset
+    construction. Each DFA state stands for a set of NFA states, and its
+    transition on a class of the program's Alphabet is computed the
+    first time a character of that class is read in that state and
+    memoized afterwards, so a warm DFA costs a class lookup and a list
+    index per character. At most `max_states` DFA states are cached:
+    when the cap is reached the cache is flushed and rebuilt on demand.
+    A DFA that has been flushed more than `max_flushes` times is
+    thrashing, and defers to plain NFA simulation from then on.
+    '''
+
+    MAX_STATES = 1000
+    MAX_FLUSHES = 10
+
+    def __init__(self, program, max_states=MAX_STATES,
+                 max_flushes=MAX_FLUSHES):
+        self.program = program
+        self.alphabet = program.alphabet
+        self.max_states = max_states
+        self.max_flushes = max_flushes
+        self.flushes = 0
+        # transitions computed, that is cache misses
+        self.misses = 0
+        self.states = {}
+        self.start_state = self.find_state(program.start_states)
+
+    def find_state(self, nfa_states):
+        '''
+        Returns the cached DFA state for a set of NFA states, creating
+        it if necessary.
+        '''
+        state = self.states.get(nfa_states)
+        if state is None:
+            state = DFAState(nfa_states, self.program.is_match(nfa_states),
+                             self.alphabet.size)
+            self.states[nfa_states] = state
+        return state
+
+    def flush(self):
+        '''
+        Empties the state cache, keeping only the start state.
+        '''
+        self.flushes += 1
+        self.states = {}
+        self.start_state = self.find_state(self.start_state.nfa_states)
+
+    def transition(self, state, class_id):
+        '''
+        Computes and memoizes the transition from `state` on the
+        characters of class `class_id`.
+        '''
+        self.misses += 1
+        code = self.alphabet.representatives[class_id]
+        nfa_states = frozenset(self.program.step(state.nfa_states, code))
+        if (nfa_states not in self.states
+                and len(self.states) >= self.max_states):
+            self.flush()
+        next_state = self.find_state(nfa_states)
+        state.next[class_id] = next_state
+        return next_state
+
+    def simulate(self, string):
+        '''
+        Returns True if the DFA accepts the string, otherwise False.
+        '''
+        if self.flushes > self.max_flushes:
+            return self.program.simulate(string)
+
+        return self.run(self.start_state, iter_codes(string)).is_match
+
+    def run(self, state, codes):
+        '''
+        Returns the DFA state reached by reading the characters (or
+        bytes) `codes` from `state`.
+        '''
+        table = self.alphabet.table
+        classify = self.alphabet.classify
+        for code in codes:
+            if code < Alphabet.TABLE_SIZE:
+                class_id = table[code]
+            else:
+                class_id = classify(code)
+            next_state = state.next[class_id]
+            if next_state is None:
+                if not state.nfa_states:
+                    # the dead state: nothing more can match
+                    break
+                next_state = self.transition(state, class_id)
+            state = next_state
+
+        return state
+
+
+class DFAState(object):
+    '''
+    A DFA state is a set of NFA state ids together with the transitions
+    out of it that have been computed so far, indexed by class id.
+    '''
+
+    __slots__ = ('nfa_states', 'is_match', 'next')
+
+    def __init__(self, nfa_states, is_match, size):
+        self.nfa_states = nfa_states
+        self.is_match = is_match
+        self.next = [None] * size
+
+
+class MinimalDFA(object):
+    '''
+    A complete DFA built eagerly from a Program by subset construction
+    over the classes of its Alphabet, then minimized with Hopcroft's
+    algorithm, so that states the Thompson construction duplicates (as
+    in `(a|a)*`) are merged. States are numbered from 0, the start
+    state; the state reached from state q on class c is
+    table[q * alphabet.size + c], and `accepting` flags accept states.
+    `dead` is the state from which no string is accepted, and
+    `universal` the state from which every string is, or -1; matching
+    stops as soon as either is reached.
+    '''
+
+    __slots__ = ('alphabet', 'table', 'accepting', 'dead', 'universal',
+                 'function')
+
+    MAX_STATES = 10000
+    MAX_CODEGEN_STATES = 256
+
+    def __init__(self, alphabet, table, accepting, dead=None,
+                 universal=None):
+        self.alphabet = alphabet
+        self.table = table
+        self.accepting = accepting
+        self.function = None
+        self.dead = dead
+        self.universal = universal
+        if dead is not None:
+            return
+        self.dead = -1
+        self.universal = -1
+        size = alphabet.size
+        # the DFA is minimal, so it has at most one state of each kind
+        for state in range(len(accepting)):
+            if all(table[state * size + class_id] == state
+                   for class_id in range(size)):
+                if accepting[state]:
+                    self.universal = state
+                else:
+                    self.dead = state
+
+    @staticmethod
+    def from_program(program, max_states=MAX_STATES):
+        '''
+        Returns the minimal DFA of `program`, or None if the DFA built
+        by subset construction has more than `max_states` states.
+        '''
+        alphabet = program.alphabet
+        size = alphabet.size
+        ids = {program.start_states: 0}
+        sets = [program.start_states]
+        table = []
+        for nfa_states in sets:
+            for class_id in range(size):
+                next_states = frozenset(program.step(
+                    nfa_states, alphabet.representatives[class_id]))
+                if next_states not in ids:
+                    if len(sets) == max_states:
+                        return None
+                    ids[next_states] = len(sets)
+                    sets.append(next_states)
+                table.append(ids[next_states])
+        accepting = [program.is_match(nfa_states) for nfa_states in sets]
+
+        return MinimalDFA.minimize(alphabet, table, accepting)
+
+    @staticmethod
+    def minimize(alphabet, table, accepting):
+        '''
+        Returns the minimal DFA equivalent to the complete DFA given by
+        `table` and `accepting`, whose start state is 0, by Hopcroft's
+        partition refinement.
+        '''
+        size = alphabet.size
+        count = len(accepting)
+        inverse = [[[] for state in range(count)] for class_id in range(size)]
+        for state in range(count):
+            for class_id in range(size):
+                inverse[class_id][table[state * size + class_id]].append(state)
+
+        blocks = []
+        block_of = [0] * count
+        for accept in (True, False):
+            block = set(state for state in range(count)
+                        if accepting[state] == accept)
+            if block:
+                for state in block:
+                    block_of[state] = len(blocks)
+                blocks.append(block)
+
+        work = set(range(len(blocks)))
+        while work:
+            splitter = list(blocks[work.pop()])
+            for class_id in range(size):
+                # the states that enter the splitter on class_id, grouped
+                # by the block they are in
+                touched = {}
+                for state in splitter:
+                    for previous in inverse[class_id][state]:
+                        touched.setdefault(block_of[previous], set()).add(
+                            previous)
+                for block_id, states in touched.items():
+                    if len(states) == len(blocks[block_id]):
+                        continue
+                    blocks[block_id] -= states
+                    new_id = len(blocks)
+                    blocks.append(states)
+                    for state in states:
+                        block_of[state] = new_id
+                    if block_id in work:
+                        work.add(new_id)
+                    elif len(states) <= len(blocks[block_id]):
+                        work.add(new_id)
+                    else:
+                        work.add(block_id)
+
+        # renumber the blocks so the start state's block comes first
+        numbers = {block_of[0]: 0}
+        for state in range(count):
+            numbers.setdefault(block_of[state], len(numbers))
+        representatives = [0] * len(numbers)
+        for state in range(count):
+            representatives[numbers[block_of[state]]] = state
+
+        minimal_table = array('i')
+        minimal_accepting = []
+        for state in representatives:
+            for class_id in range(size):
+                minimal_table.append(
+                    numbers[block_of[table[state * size + class_id]]])
+            minimal_accepting.append(accepting[state])
+
+        return MinimalDFA(alphabet, minimal_table, minimal_accepting)
+
+    def __len__(self):
+        return len(self.accepting)
+
+    def ranges(self, state):
+        '''
+        Returns a dict mapping each state reachable from `state` in one
+        step to the list of (first, last) code ranges that lead to it.
+        '''
+        alphabet = self.alphabet
+        offset = state * alphabet.size
+        targets = {}
+        bounds = list(alphabet.bounds) + [sys.maxunicode + 1]
+        for index, class_id in enumerate(alphabet.ids):
+            target = self.table[offset + class_id]
+            ranges = targets.setdefault(target, [])
+            first, last = bounds[index], bounds[index + 1] - 1
+            if ranges and ranges[-1][1] == first - 1:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return targets
+
+    def source(self, name='match'):
+        '''
+        Returns the source of a Python function `name` that takes an
+        iterable of codes and returns True if the DFA accepts them. The
+        state is a local integer dispatched on by an if/elif chain, and
+        each state tests the code against the ranges of its transitions,
+        so matching needs no table lookups or attribute accesses.
+        '''
+        lines = ['def {name}(codes):'.format(name=name),
+                 '    state = 0',
+                 '    for code in codes:']
+        keyword = 'if'
+        for state in range(len(self.accepting)):
+            if state == self.dead or state == self.universal:
+                continue
+            lines.append('        {keyword} state == {state}:'.format(
+                keyword=keyword, state=state))
+            keyword = 'elif'
+            targets = self.ranges(state)
+            # the target reached on the most ranges needs no test
+            default = max(targets, key=lambda target: (
+                len(targets[target]), target == self.dead))
+            branch = 'if'
+            for target, ranges in targets.items():
+                if target == default:
+                    continue
+                lines.append('            {branch} {test}:'.format(
+                    branch=branch, test=' or '.join(
+                        MinimalDFA.range_test(first, last)
+                        for first, last in ranges)))
+                lines.append('                ' + self.goto(state, target))
+                branch = 'elif'
+            indent = '            '
+            if branch == 'elif':
+                lines.append('            else:')
+                indent = '                '
+            lines.append(indent + self.goto(state, default))
+        if keyword == 'if':
+            # the start state is dead or universal
+            lines.append('        return {accepts}'.format(
+                accepts=bool(self.accepting[0])))
+        accepting = [state for state in range(len(self.accepting))
+                     if self.accepting[state]]
+        lines.append('    return state in {accepting!r}'.format(
+            accepting=tuple(accepting)))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def range_test(first, last):
+        if first == last:
+            return 'code == {first}'.format(first=first)
+        if last == sys.maxunicode:
+            return 'code >= {first}'.format(first=first)
+        if first == 0:
+            return 'code <= {last}'.format(last=last)
+        return '{first} <= code <= {last}'.format(first=first, last=last)
+
+    def goto(self, state, target):
+        if target == self.dead:
+            return 'return False'
+        if target == self.universal:
+            return 'return True'
+        if target == state:
+            return 'pass'
+        return 'state = {target}'.format(target=target)
+
+    def compile_function(self):
+        '''
+        Compiles the source of the DFA's matching function once and keeps
+        it for `simulate` to call. Returns the function, or None if the
+        DFA has more than MAX_CODEGEN_STATES states.
+        '''
+        if self.function is None and \
+                len(self.accepting) <= MinimalDFA.MAX_CODEGEN_STATES:
+            namespace = {}
+            code = builtins.compile(self.source(), '<regex>', 'exec')
+            exec(code, namespace)
+            self.function = namespace['match']
+        return self.function
+
+    def simulate_array(self, column):
+        '''
+        Returns a boolean NumPy array telling which strings of the
+        fixed-width string or bytes array `column` the DFA accepts.
+        NumPy pads shorter strings with NULs, so the state of each row
+        stops advancing at its last non-NUL character.
+        '''
+        column = numpy.ascontiguousarray(
+            column, dtype=column.dtype.newbyteorder('='))
+        width = column.dtype.itemsize
+        if column.dtype.kind == 'U':
+            width //= 4
+            codes = column.reshape(-1).view(numpy.uint32)
+        else:
+            codes = column.reshape(-1).view(numpy.uint8)
+        codes = codes.reshape(-1, width)
+
+        nonzero = codes != 0
+        lengths = width - numpy.argmax(nonzero[:, ::-1], axis=1)
+        lengths[~nonzero.any(axis=1)] = 0
+
+        alphabet = self.alphabet
+        table = numpy.asarray(self.table, dtype=numpy.intp).reshape(
+            -1, alphabet.size)
+        bounds = numpy.asarray(alphabet.bounds, dtype=numpy.int64)
+        ids = numpy.asarray(alphabet.ids, dtype=numpy.intp)
+        states = numpy.zeros(len(codes), dtype=numpy.intp)
+        for position in range(width):
+            running = lengths > position
+            if not running.any():
+                break
+            class_ids = ids[numpy.searchsorted(
+                bounds, codes[:, position], side='right') - 1]
+            states = numpy.where(running, table[states, class_ids], states)
+            if self.dead >= 0 and (states == self.dead).all():
+                break
+
+        accepting = numpy.asarray(self.accepting, dtype=bool)
+        return accepting[states].reshape(column.shape)
+
+    def simulate(self, string):
+        '''
+        Returns True if the DFA accepts the string, otherwise False.
+        '''
+        if self.function is not None:
+            return self.function(iter_codes(string))
+        return bool(self.accepting[self.run(0, iter_codes(string))])
+
+    def run(self, state, codes):
+        '''
+        Returns the state reached by reading the characters (or bytes)
+        `codes` from `state`, stopping early at the dead or universal
+        state.
+        '''
+        table = self.table
+        classes = self.alphabet.table
+        classify = self.alphabet.classify
+        size = self.alphabet.size
+        dead = self.dead
+        universal = self.universal
+        if state == dead or state == universal:
+            return state
+        for code in codes:
+            if code < Alphabet.TABLE_SIZE:
+                class_id = classes[code]
+            else:
+                class_id = classify(code)
+            state = table[state * size + class_id]
+            if state == dead or state == universal:
+                break
+
+        return state
+
+
+class State(object):
+    '''
+    Each state is a node defined by its out edges. A state may be an
+    accept state or not. Once its NFA is compiled, a state also has a
+    dense integer id.
+    '''
+
+    __slots__ = ('out1', 'out2', 'is_match', 'id')
+
+    def __init__(self, out1=None, out2=None, is_match=False):
+        self.out1 = out1
+        self.out2 = out2
+        self.is_match = is_match
+        self.id = None
+
+
+class Edge(object):
+    '''
+    An edge has a character (which may be the empty string) and a target
+    state (which may be None in the case of dangling edges).
+    '''
+
+    __slots__ = ('to_state', 'token')
+
+    def __init__(self, token, to_state=None):
+        self.to_state = to_state
+        self.token = token
+
+
+CHUNK_SIZE = 1 << 16
+
+
+def common_prefix(strings):
+    '''
+    Returns the longest common prefix of a collection of strings.
+    '''
+    strings = list(strings)
+    if len(strings) < 2:
+        return strings[0] if strings else ''
+    shortest = min(strings)
+    longest = max(strings)
+    for index, c in enumerate(shortest):
+        if c != longest[index]:
+            return shortest[:index]
+    return shortest
+
+
+def common_suffix(strings):
+    '''
+    Returns the longest common suffix of a collection of strings.
+    '''
+    return common_prefix([s[::-1] for s in strings])[::-1]
+
+
+def iter_slices(data, size, pos=0):
+    '''
+    Yields the consecutive slices of `size` items of the string or
+    bytes-like object `data` from `pos` on, without copying bytes-like
+    objects.
+    '''
+    if not isinstance(data, str):
+        data = memoryview(data).cast('B')
+    for start in range(pos, len(data), size):
+        yield data[start:start + size]
+
+
+def iter_chunks(iterable, size):
+    '''
+    Yields lists of `size` consecutive items of `iterable`, the last one
+    possibly shorter.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# the Regex of a Regex.test_many worker process
+worker_regex = None
+
+
+def init_worker(regex):
+    global worker_regex
+    worker_regex = regex
+
+
+def test_chunk(strings):
+    '''
+    Tests a chunk of strings in a worker process, returning one byte per
+    string: 1 if it matches, 0 otherwise.
+    '''
+    test = worker_regex.test
+    return bytes(1 if test(string) else 0 for string in strings)
+
+
+def check_type(data, binary):
+    '''
+    Raises TypeError if `data` is a string and the pattern is binary, or
+    the other way around.
+    '''
+    if isinstance(data, str) == binary:
+        raise TypeError('cannot use a {pattern} pattern on a {input}'.format(
+            pattern='binary' if binary else 'string',
+            input='string' if binary else 'bytes-like object'))
+
+
+def iter_codes(data):
+    '''
+    Returns an iterator over the code points of a string, or over the
+    byte values of a bytes-like object such as bytes, a memoryview or an
+    mmap, without copying it.
+    '''
+    if isinstance(data, str):
+        return map(ord, data)
+    return iter(as_codes(data))
+
+
+def as_codes(data):
+    '''
+    Returns `data` as a sequence that can be indexed by offset: a string
+    as is, or a bytes-like object as a memoryview of its bytes. Indexing
+    a string gives characters, and indexing the view gives byte values.
+    '''
+    if isinstance(data, str):
+        return data
+    return memoryview(data).cast('B')
+
+
+def utf8_ranges(first, last):
+    '''
+    Yields the UTF-8 encodings of the code points from `first` to `last`
+    as sequences of byte ranges: each sequence is a list of (first,
+    last) byte ranges, and a code point is in the range if its encoding
+    is one byte from each range of one of the sequences. Surrogates,
+    which have no UTF-8 encoding, are skipped. This is the algorithm of
+    RE2 and of Rust's utf8-ranges.
+    '''
+    stack = [(first, last)]
+    while stack:
+        first, last = stack.pop()
+        while True:
+            if first <= 0xDFFF and last >= 0xD800:
+                # split around the surrogates
+                if last > 0xDFFF:
+                    stack.append((0xE000, last))
+                if first < 0xD800:
+                    last = 0xD7FF
+                    continue
+                break
+
+            split = False
+            for max_code in (0x7F, 0x7FF, 0xFFFF):
+                if first <= max_code < last:
+                    stack.append((max_code + 1, last))
+                    last = max_code
+                    split = True
+                    break
+            if split:
+                continue
+
+            if last <= 0x7F:
+                yield [(first, last)]
+                break
+
+            for index in (1, 2, 3):
+                mask = (1 << (6 * index)) - 1
+                if first & ~mask != last & ~mask:
+                    if first & mask != 0:
+                        stack.append(((first | mask) + 1, last))
+                        last = first | mask
+                        split = True
+                        break
+                    if last & mask != mask:
+                        stack.append((last & ~mask, last))
+                        last = (last & ~mask) - 1
+                        split = True
+                        break
+            if split:
+                continue
+
+            first_bytes = chr(first).encode('utf-8')
+            last_bytes = chr(last).encode('utf-8')
+            yield list(zip(first_bytes, last_bytes))
+            break
+
+
+def main():
+    # a flag rather than a word, so that no pattern is taken for it
+    if sys.argv[1:2] == ['--precompile']:
+        precompile(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description='Prints the words that match a regular expression. '
+        'Without words, searches the given files (or standard input) '
+        'and prints the offsets of each match. Options go before the '
+        'pattern; everything after it is a word, even if it starts '
+        'with -.',
+        epilog='regex.py --precompile RULES OUTPUT compiles a rule file '
+        'into an archive instead; see regex.py --precompile -h.')
+    parser.add_argument('expr')
+    parser.add_argument('words', nargs=argparse.REMAINDER)
+    parser.add_argument('-f', '--file', action='append', dest='files',
+                        default=[], help='file to search (repeatable)')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='search the raw UTF-8 bytes of the input, '
+                        'memory-mapping files instead of reading them')
+    args = parser.parse_args()
+    if args.words and args.files:
+        parser.error('words cannot be combined with -f')
+
+    re = Regex(args.expr, binary=args.binary)
+    if args.words:
+        for word in args.words:
+            if re.test(word.encode('utf-8') if args.binary else word):
+                print(word)
+        return
+
+    if not args.files:
+        search_stream(re, sys.stdin.buffer if args.binary else sys.stdin,
+                      '-')
+    for path in args.files:
+        if args.binary:
+            search_file(re, path)
+        else:
+            with open(path) as stream:
+                search_stream(re, stream, path)
+
+
+def precompile(argv):
+    '''
+    Compiles a file of patterns, one per line, into an Archive.
+    '''
+    parser = argparse.ArgumentParser(
+        prog='regex.py --precompile',
+        description='Compiles the patterns in a rule file, one per line, '
+        'into an archive that can be loaded without compiling them again.')
+    parser.add_argument('rules')
+    parser.add_argument('output')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='compile the patterns to match UTF-8 bytes')
+    parser.add_argument('-m', '--max-states', type=int, default=None,
+                        help='largest DFA to store for a pattern; larger '
+                        'ones are stored as source and compiled on load')
+    args = parser.parse_args(argv)
+
+    with open(args.rules) as stream:
+        exprs = [line.rstrip('\n') for line in stream if line.strip()]
+    Archive.dump(exprs, args.output, binary=args.binary,
+                 max_dfa_states=args.max_states)
+
+
+def print_span(name, start, end):
+    print('{name}:{start}:{end}'.format(name=name, start=start, end=end))
+
+
+def search_file(re, path):
+    '''
+    Searches a file with a binary Regex through a memory map, printing
+    the byte offsets of each match.
+    '''
+    with open(path, 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            for match in re.finditer(b''):
+                print_span(path, match.start, match.end)
+            return
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in re.finditer(data):
+                print_span(path, match.start, match.end)
+
+
+def search_stream(re, stream, name):
+    '''
+    Feeds `stream` to a searching matcher one chunk at a time, printing
+    the offsets of matches as they are found.
+    '''
+    matcher = re.matcher(search=True)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        for start, end in matcher.feed(chunk):
+            print_span(name, start, end)
+    for start, end in matcher.finish():
+        print_span(name, start, end)
 
 
 if __name__ == '__main__':
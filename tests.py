@@ -1,43 +1,248 @@
+import asyncio
+import mmap
+import os
+import pickle
+import tempfile
+import threading
 import unittest
+import unittest.mock
 
-from regex import Regex, Token
+import regex as regex_module
+from benchmarks.__main__ import compare, measure
+from regex import (DFA, OP_CHAR, OP_CLASS, OP_MATCH, OP_SPLIT, Alphabet,
+                   Archive, CharClass, LimitExceeded, Limits, LiteralInfo,
+                   MinimalDFA, PatternCache, PatternError, Regex, RegexSet,
+                   Token)
 
 
 class TestExpressionParser(unittest.TestCase):
 
-    def test_insert_concat_operator(self):
-        self.assertEqual(Regex.insert_concat_operator('ab'), 'a.b')
-        self.assertEqual(Regex.insert_concat_operator('abc'), 'a.b.c')
-        self.assertEqual(Regex.insert_concat_operator('ab*'), 'a.b*')
-        self.assertEqual(Regex.insert_concat_operator(
-            'a((abc)*c)*'), 'a.((a.b.c)*.c)*')
-        self.assertEqual(Regex.insert_concat_operator(
-            '(ab)*(cd)*'), '(a.b)*.(c.d)*')
-        self.assertEqual(Regex.insert_concat_operator('a(bb)+a'), 'a.(b.b)+.a')
-        self.assertEqual(Regex.insert_concat_operator(
-            'a[a-z]+a'), 'a.[a-z]+.a')
-
-    def test_convert_infix_to_post(self):
-        self.assertEqual(Regex.convert_infix_to_post('a.b'), 'ab.')
-        self.assertEqual(Regex.convert_infix_to_post('a.b.c'), 'ab.c.')
-        self.assertEqual(Regex.convert_infix_to_post('a.b*'), 'ab*.')
-        self.assertEqual(Regex.convert_infix_to_post(
-            'a.((a.b.c)*.c)*'), 'aab.c.*c.*.')
-        self.assertEqual(Regex.convert_infix_to_post(
-            '(a.b)*.(c.d)*'), 'ab.*cd.*.')
-        self.assertEqual(Regex.convert_infix_to_post('a.(b.b)+.a'), 'abb.+.a.')
-        self.assertEqual(Regex.convert_infix_to_post(
-            'a.[a-z]+.a'), 'a[a-z]+.a.')
-
-    def test_tokenize(self):
-        self.assertEqual(Regex.tokenize('ab.'), [Token(
+    def postfix(self, expr):
+        return ''.join(
+            token.type if token.type != 'literal'
+            else token.value if len(token.value) <= 1
+            else '[' + token.value + ']' for token in Regex.parse(expr))
+
+    def test_parse(self):
+        self.assertEqual(self.postfix('ab'), 'ab.')
+        self.assertEqual(self.postfix('abc'), 'ab.c.')
+        self.assertEqual(self.postfix('ab*'), 'ab*.')
+        self.assertEqual(self.postfix('a((abc)*c)*'), 'aab.c.*c.*.')
+        self.assertEqual(self.postfix('(ab)*(cd)*'), 'ab.*cd.*.')
+        self.assertEqual(self.postfix('a(bb)+a'), 'abb.+.a.')
+        self.assertEqual(self.postfix('a[a-z]+a'), 'a[a-z]+.a.')
+        self.assertEqual(self.postfix('a|bc|d'), 'abc.|d|')
+        # '.' is a literal, not the concatenation operator
+        self.assertEqual(self.postfix('a.b'), 'a..b.')
+
+    def test_tokens(self):
+        self.assertEqual(Regex.parse('ab'), [Token(
             'literal', 'a'), Token('literal', 'b'), Token('.')])
-        self.assertEqual(Regex.tokenize('ab.c.'), [Token('literal', 'a'), Token(
+        self.assertEqual(Regex.parse('abc'), [Token('literal', 'a'), Token(
             'literal', 'b'), Token('.'), Token('literal', 'c'), Token('.')])
-        self.assertEqual(Regex.tokenize(
-            'ab*.'), [Token('literal', 'a'), Token('literal', 'b'), Token('*'), Token('.')])
-        self.assertEqual(Regex.tokenize('a[a-z]+.a.'), [Token('literal', 'a'), Token(
-            'literal', 'a-z'), Token('+'), Token('.'), Token('literal', 'a'), Token('.')])
+        self.assertEqual(Regex.parse('ab*'), [
+            Token('literal', 'a'), Token('literal', 'b'), Token('*'),
+            Token('.')])
+        self.assertEqual(Regex.parse('a[a-z]+a'), [
+            Token('literal', 'a'), Token('literal', 'a-z'), Token('+'),
+            Token('.'), Token('literal', 'a'), Token('.')])
+
+
+class TestParser(unittest.TestCase):
+
+    def test_shares_tokens(self):
+        tokens = Regex.parse('abab|(a)*')
+        literals = [token for token in tokens if token.type == 'literal']
+        self.assertEqual(len(set(map(id, literals))), 2)
+        nfa = Regex('a?b|c*').nfa
+        epsilon_tokens = set()
+        stack = [nfa.start_state]
+        seen = set()
+        while stack:
+            state = stack.pop()
+            if id(state) in seen:
+                continue
+            seen.add(id(state))
+            for edge in (state.out1, state.out2):
+                if edge and edge.token.value == '':
+                    epsilon_tokens.add(id(edge.token))
+                if edge and edge.to_state:
+                    stack.append(edge.to_state)
+        self.assertEqual(len(epsilon_tokens), 1)
+
+    def test_empty_alternatives(self):
+        self.assertTrue(Regex('').test(''))
+        self.assertFalse(Regex('').test('a'))
+        self.assertTrue(Regex('a|').test(''))
+        self.assertTrue(Regex('(|b)c').test('c'))
+        self.assertTrue(Regex('a()b').test('ab'))
+
+    def test_positioned_errors(self):
+        cases = [('ab[cd', 'unclosed [', 2), ('a(b|c', 'unclosed (', 1),
+                 ('ab)', 'unbalanced )', 2), ('a|*b', 'nothing to repeat', 2),
+                 ('(+a)', 'nothing to repeat', 1),
+                 ('a[z-a]', 'Invalid range', 1),
+                 ('a{3,2}', 'invalid repetition', 1)]
+        for expr, message, position in cases:
+            with self.assertRaises(PatternError) as context:
+                Regex(expr)
+            self.assertIn(message, str(context.exception))
+            self.assertEqual(context.exception.position, position)
+
+    def test_graph_mirrors_program(self):
+        def target(edge):
+            return edge.to_state.id if edge else -1
+
+        for expr in ['a((abc)*c)*', '(a?){3}', '((a*)?b|c+)*d', '',
+                     '[a-z\u00e9]+|x?', '(a|)*']:
+            for binary in (False, True):
+                program = Regex(expr, binary=binary).program
+                nfa = regex_module.NFA.from_program(program)
+                self.assertIs(nfa.start_state, nfa.states[program.start])
+                for state_id, state in enumerate(nfa.states):
+                    op = program.ops[state_id]
+                    self.assertEqual(state.is_match, op == OP_MATCH)
+                    self.assertEqual(target(state.out1),
+                                     program.out1[state_id])
+                    self.assertEqual(target(state.out2),
+                                     program.out2[state_id])
+                    if op == OP_CLASS:
+                        self.assertEqual(
+                            state.out1.token.chars,
+                            program.classes[program.args[state_id]])
+                    elif op != OP_CHAR and state.out1:
+                        self.assertIs(state.out1.token, regex_module.EPSILON)
+
+    def test_long_alternation(self):
+        words = ['w{index}x'.format(index=index) for index in range(5000)]
+        regex = Regex('|'.join(words))
+        self.assertTrue(regex.test('w4321x'))
+        self.assertFalse(regex.test('w5000x'))
+        self.assertEqual(regex.fast_path.shape, 'strings')
+
+
+class TestCountedRepetition(unittest.TestCase):
+
+    def test_parses_repetitions(self):
+        self.assertEqual(Regex.parse('a{2,3}b'), Regex.parse('aa(a)?b'))
+        self.assertEqual(Regex.parse('(ab){2}'), Regex.parse('(ab)(ab)'))
+        self.assertEqual(Regex.parse('ab{2,}|c'), Regex.parse('a(bb+)|c'))
+        self.assertEqual(Regex.parse('a{,3}'), Regex.parse('(a(a(a)?)?)?'))
+        # braces that are not repetitions are literal
+        self.assertTrue(Regex('a{x}').test('a{x}'))
+        self.assertTrue(Regex('a{').test('a{'))
+
+    def test_nests_optional_copies(self):
+        self.assertEqual(Regex.parse('a{1,3}'), Regex.parse('a(a(a)?)?'))
+        self.assertEqual(Regex.parse('a{2,}'), Regex.parse('aa+'))
+        self.assertEqual(Regex.parse('a{0,}'), Regex.parse('a*'))
+
+    def test_matches(self):
+        cases = {
+            '[A-Z]{2}[0-9]{6,12}': (
+                ['AB123456', 'XY123456789012'],
+                ['AB12345', 'A1234567', 'AB1234567890123']),
+            '(ab){2,}': (['abab', 'ababab'], ['', 'ab', 'aba']),
+            'a{0}b': (['b'], ['ab']),
+            '(a?){3}a{3}': (['aaa', 'aaaaaa'], ['aa', 'aaaaaaa']),
+            '(a*){2,3}b': (['b', 'aab'], ['a', 'ba']),
+        }
+        for expr, (matching, other) in cases.items():
+            regex = Regex(expr)
+            for string in matching:
+                self.assertTrue(regex.test(string), (expr, string))
+            for string in other:
+                self.assertFalse(regex.test(string), (expr, string))
+
+    def test_rejects_bad_repetitions(self):
+        with self.assertRaises(ValueError):
+            Regex('a{3,2}')
+        with self.assertRaises(ValueError):
+            Regex('{2}')
+        with self.assertRaises(ValueError):
+            Regex('[a-z]{20000}')
+        with self.assertRaises(ValueError):
+            Regex('((ab){100}){100}')
+
+    def test_rejects_large_repetitions_early(self):
+        for expr, position in [('a{0,10000}', 1), ('x[a-z]{20000}', 6),
+                               ('((ab){100}){100}', 11)]:
+            with self.assertRaises(PatternError) as context:
+                Regex(expr)
+            self.assertIn('too large', str(context.exception))
+            self.assertEqual(context.exception.position, position)
+
+    def test_repeat(self):
+        def postfix(tokens):
+            return ''.join(token.value if token.type == 'literal'
+                           else token.type for token in tokens)
+
+        x = Token('literal', 'x')
+        self.assertEqual(postfix(Regex.repeat([x], 2, 4)), 'xx.xx?.?.')
+        self.assertEqual(postfix(Regex.repeat([x], 3, None)), 'xx.x+.')
+        self.assertEqual(Regex.repeat([x], 0, 0), [regex_module.EPSILON])
+
+
+class TestCharClass(unittest.TestCase):
+
+    def test_merges_ranges(self):
+        self.assertEqual(CharClass.parse('a-z').ranges, ((97, 122),))
+        self.assertEqual(CharClass.parse('a-za').ranges, ((97, 122),))
+        self.assertEqual(CharClass.parse('a-mn-z').ranges, ((97, 122),))
+        self.assertEqual(CharClass.parse('aabb').ranges, ((97, 98),))
+        self.assertEqual(CharClass.parse('A-Za-z').ranges,
+                         ((65, 90), (97, 122)))
+
+    def test_literal_hyphen(self):
+        self.assertIn('-', CharClass.parse('-a'))
+        self.assertIn('-', CharClass.parse('a-'))
+        self.assertNotIn('b', CharClass.parse('a-'))
+
+    def test_rejects_reversed_range(self):
+        self.assertRaises(ValueError, CharClass.parse, 'z-a')
+
+    def test_membership(self):
+        chars = CharClass.parse('0-9A-F\u0400-\u04ff')
+        self.assertIn('7', chars)
+        self.assertIn('F', chars)
+        self.assertIn('\u0416', chars)
+        self.assertNotIn('G', chars)
+        self.assertNotIn('\u0500', chars)
+        self.assertNotIn('\u00ff', chars)
+
+    def test_wide_range_stays_small(self):
+        chars = CharClass.parse('\u0000-\uffff')
+        self.assertEqual(len(chars.ranges), 1)
+        self.assertEqual(len(chars), 0x10000)
+        self.assertIn('\uabcd', chars)
+        self.assertTrue(Regex('[\u0100-\uffff]+').test('\u4e2d\u6587'))
+
+
+class TestAlphabet(unittest.TestCase):
+
+    def test_partitions_by_membership(self):
+        alphabet = Alphabet([CharClass.parse('a-z'), CharClass.parse('m')])
+        self.assertEqual(alphabet.size, 3)
+        self.assertEqual(alphabet.classify(ord('a')),
+                         alphabet.classify(ord('z')))
+        self.assertNotEqual(alphabet.classify(ord('a')),
+                            alphabet.classify(ord('m')))
+        self.assertEqual(alphabet.classify(ord('A')),
+                         alphabet.classify(0x4e2d))
+
+    def test_classifies_beyond_table(self):
+        alphabet = Alphabet([CharClass.parse('\u0400-\u04ff')])
+        self.assertEqual(alphabet.size, 2)
+        self.assertEqual(alphabet.classify(0x416), alphabet.classify(0x400))
+        self.assertEqual(alphabet.classify(0x500), alphabet.classify(ord('a')))
+
+    def test_compiled_pattern(self):
+        alphabet = Regex('[A-Za-z]+[0-9]*x').program.alphabet
+        self.assertEqual(alphabet.size, 4)
+        self.assertNotEqual(alphabet.classify(ord('x')),
+                            alphabet.classify(ord('y')))
+        self.assertEqual(alphabet.classify(ord('A')),
+                         alphabet.classify(ord('y')))
 
 
 class TestLiteral(unittest.TestCase):
@@ -322,6 +527,12 @@ class TestRange(unittest.TestCase):
         self.assertFalse(self.regex.test('6'))
         self.assertFalse(self.regex.test('@'))
 
+    def test_shares_class_table_entries(self):
+        self.regex = Regex('[a-z][a-z]')
+        program = self.regex.program
+        self.assertEqual(program.ops.count(OP_CLASS), 2)
+        self.assertEqual(len(program.classes), 1)
+
     def test_range_with_parens(self):
         self.regex = Regex('([a-z]a)*')
         self.assertTrue(self.regex.test(''))
@@ -334,5 +545,952 @@ class TestRange(unittest.TestCase):
         self.assertFalse(self.regex.test('1a'))
 
 
+class TestNestedStar(unittest.TestCase):
+
+    def setUp(self):
+        self.regex = Regex('a((abc)*c)*')
+
+    def test_assigns_dense_state_ids(self):
+        states = self.regex.nfa.states
+        self.assertEqual([state.id for state in states],
+                         list(range(len(states))))
+        self.assertEqual(self.regex.nfa.start_state.id, 0)
+
+    def test_keeps_only_program(self):
+        regex = Regex('a((abc)*c)*')
+        self.assertIsNone(regex.graph)
+        self.assertIs(regex.nfa, regex.nfa)
+        self.assertEqual(len(regex.nfa.states), len(regex.program.ops))
+
+    def test_closures_skip_epsilon_only_states(self):
+        program = self.regex.program
+        for closure in program.closures:
+            for state_id in closure or ():
+                self.assertNotEqual(program.ops[state_id], OP_SPLIT)
+        self.assertEqual(program.start_states, frozenset([0]))
+
+    def test_flattens_states_into_tables(self):
+        program = self.regex.program
+        states = self.regex.nfa.states
+        self.assertEqual(len(program.ops), len(states))
+        for state in states:
+            op = program.ops[state.id]
+            if op == OP_CHAR:
+                self.assertEqual(chr(program.args[state.id]),
+                                 state.out1.token.value)
+                self.assertEqual(program.out1[state.id],
+                                 state.out1.to_state.id)
+            elif op == OP_MATCH:
+                self.assertTrue(state.is_match)
+            else:
+                self.assertEqual(op, OP_SPLIT)
+
+    def test_passes_string_in_language(self):
+        self.assertTrue(self.regex.test('a'))
+        self.assertTrue(self.regex.test('aabcc'))
+        self.assertTrue(self.regex.test('a' + 'abcabcc' * 500))
+
+    def test_fails_string_not_in_language(self):
+        self.assertFalse(self.regex.test('aabc'))
+        self.assertFalse(self.regex.test('a' + 'abcabcc' * 500 + 'b'))
+
+
+class TestSearch(unittest.TestCase):
+
+    def test_finds_leftmost_longest(self):
+        match = Regex('ab*').search('xxabbbab')
+        self.assertEqual(match.span(), (2, 6))
+        self.assertEqual(match.group(), 'abbb')
+        self.assertEqual(Regex('a|ab').search('cab').span(), (1, 3))
+        self.assertEqual(Regex('b|abc').search('abc').span(), (0, 3))
+
+    def test_fails_when_absent(self):
+        self.assertIsNone(Regex('ab').search('aacb'))
+        self.assertIsNone(Regex('a').search(''))
+
+    def test_searches_from_pos(self):
+        self.assertEqual(Regex('ab').search('abab', 1).span(), (2, 4))
+        self.assertEqual(Regex('a*').search('aa', 5).span(), (2, 2))
+        self.assertIsNone(Regex('a').search('aa', 5))
+        self.assertEqual(Regex('a*').program.search('aa', 5), (2, 2))
+        self.assertEqual(Regex('[ab]').search('xa', -1).span(), (1, 2))
+        self.assertEqual(Regex('[ab]').search('ab', -2).span(), (0, 1))
+        self.assertEqual(Regex('ab+').search('xabb', -3).span(), (1, 4))
+        self.assertEqual(Regex('[ab]').program.search('xa', -1), (1, 2))
+        self.assertEqual(asyncio.run(
+            Regex('ab').asearch('x' * 50 + 'ab', -3, budget=8)).span(),
+            (50, 52))
+
+    def test_empty_matches(self):
+        self.assertEqual(Regex('a*').search('baa').span(), (0, 0))
+        self.assertEqual(Regex('a*').findall('baa'), ['', 'aa', ''])
+
+    def test_findall(self):
+        regex = Regex('[0-9]+')
+        self.assertEqual(regex.findall('a1b22c333'), ['1', '22', '333'])
+        self.assertEqual([match.span() for match in regex.finditer('1 22')],
+                         [(0, 1), (2, 4)])
+        self.assertEqual(Regex('(ab)+c').findall('ababcxabcabab'),
+                         ['ababc', 'abc'])
+
+    def test_long_text(self):
+        text = 'x' * 100000 + 'needle' + 'x' * 100000
+        self.assertEqual(Regex('ne+dle').search(text).span(),
+                         (100000, 100006))
+
+
+class TestMain(unittest.TestCase):
+
+    def run_main(self, *args):
+        with unittest.mock.patch('sys.argv', ['regex.py'] + list(args)), \
+                unittest.mock.patch('builtins.print') as print_:
+            regex_module.main()
+        return [call[0][0] for call in print_.call_args_list]
+
+    def test_words(self):
+        self.assertEqual(self.run_main('a|-b', 'a', '-b', 'b'), ['a', '-b'])
+        self.assertEqual(self.run_main('b', 'abc', '-xb'), [])
+        self.assertEqual(self.run_main('a', '-foo'), [])
+        self.assertEqual(self.run_main('--', '-f', '-f', 'f'), ['-f'])
+        self.assertEqual(self.run_main('-b', '[a-]+', '-a', 'x'), ['-a'])
+
+    def test_rejects_words_with_files(self):
+        with unittest.mock.patch('sys.stderr'), \
+                self.assertRaises(SystemExit):
+            self.run_main('-f', 'rules.txt', 'a', 'a')
+
+
+class TestMatcher(unittest.TestCase):
+
+    def feed_in_chunks(self, matcher, string, size):
+        spans = []
+        for index in range(0, len(string), size):
+            spans.extend(matcher.feed(string[index:index+size]))
+        return spans, matcher.finish()
+
+    def test_tests_across_chunks(self):
+        for dfa in (False, True):
+            regex = Regex('(ab)+c', dfa=dfa)
+            for string in ('ababc', 'abab', 'ababcc', ''):
+                for size in (1, 2, 3):
+                    spans, result = self.feed_in_chunks(
+                        regex.matcher(), string, size)
+                    self.assertEqual(spans, [])
+                    self.assertEqual(result, regex.test(string))
+
+    def test_searches_across_chunks(self):
+        cases = [
+            ('ab*', 'xxabbbabyab'),
+            ('a|abcd', 'abcxabcdab'),
+            ('a*', 'baab'),
+            ('[0-9]+', '12 345 6789'),
+            ('(ab)+c', 'ababcxabcabab'),
+        ]
+        for expr, string in cases:
+            regex = Regex(expr)
+            expected = [match.span() for match in regex.finditer(string)]
+            for size in (1, 2, 5, len(string)):
+                spans, rest = self.feed_in_chunks(
+                    regex.matcher(search=True), string, size)
+                self.assertEqual(spans + rest, expected)
+
+    def test_reports_matches_as_found(self):
+        matcher = Regex('ab').matcher(search=True)
+        self.assertEqual(matcher.feed('xxab'), [])
+        self.assertEqual(matcher.feed('x'), [(2, 4)])
+        self.assertEqual(matcher.feed('a'), [])
+        self.assertEqual(matcher.finish(), [])
+
+    def test_buffers_little(self):
+        matcher = Regex('needle').matcher(search=True)
+        for i in range(1000):
+            matcher.feed('x' * 100)
+        self.assertEqual(matcher.buffer, '')
+        self.assertEqual(matcher.feed('needl'), [])
+        self.assertEqual(matcher.buffer, 'needl')
+        self.assertEqual(matcher.feed('e'), [])
+        self.assertEqual(matcher.finish(), [(100000, 100006)])
+
+    def test_cannot_feed_after_finish(self):
+        matcher = Regex('a').matcher()
+        matcher.finish()
+        self.assertRaises(ValueError, matcher.feed, 'a')
+
+
+class TestBinary(unittest.TestCase):
+
+    def test_matches_ascii_bytes(self):
+        regex = Regex('(ab)+c', binary=True)
+        self.assertTrue(regex.test(b'ababc'))
+        self.assertFalse(regex.test(b'abab'))
+        self.assertTrue(regex.test(bytearray(b'abc')))
+        self.assertTrue(regex.test(memoryview(b'xabcx')[1:4]))
+
+    def test_matches_utf8_encodings(self):
+        regex = Regex('[a-z\u00e9]+[\u4e00-\u9fff]', binary=True)
+        self.assertTrue(regex.test('caf\u00e9\u4e2d'.encode('utf-8')))
+        self.assertFalse(regex.test('cafe\u00e8\u4e2d'.encode('utf-8')))
+        self.assertFalse(regex.test('caf\u00e9'.encode('utf-8')[:-1]))
+        self.assertTrue(Regex('[\u0000-\U0010ffff]*', binary=True).test(
+            'a\u00e9\u4e2d\U0001f600'.encode('utf-8')))
+
+    def test_searches_bytes(self):
+        regex = Regex('\u00e9+', binary=True)
+        match = regex.search('caf\u00e9\u00e9!'.encode('utf-8'))
+        self.assertEqual(match.span(), (3, 7))
+        self.assertEqual(match.group(), '\u00e9\u00e9'.encode('utf-8'))
+
+    def test_searches_mmap(self):
+        with tempfile.TemporaryFile() as stream:
+            stream.write(b'x' * 10000 + b'needle' + b'x' * 10000)
+            stream.flush()
+            with mmap.mmap(stream.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                regex = Regex('ne+dle', binary=True)
+                self.assertEqual([match.span()
+                                  for match in regex.finditer(data)],
+                                 [(10000, 10006)])
+                self.assertFalse(regex.test(data))
+
+    def test_streams_split_characters(self):
+        regex = Regex('\u00e9', binary=True)
+        data = 'a\u00e9b'.encode('utf-8')
+        matcher = regex.matcher(search=True)
+        spans = matcher.feed(data[:2]) + matcher.feed(data[2:])
+        self.assertEqual(spans + matcher.finish(), [(1, 3)])
+
+    def test_rejects_mismatched_input(self):
+        self.assertRaises(TypeError, Regex('a', binary=True).test, 'a')
+        self.assertRaises(TypeError, Regex('a').test, b'a')
+        self.assertRaises(TypeError, Regex('a').matcher().feed, b'a')
+
+
+class TestPrefilter(unittest.TestCase):
+
+    def literal_info(self, expr):
+        return LiteralInfo.from_tokens(Regex.parse(expr))
+
+    def test_extracts_prefix_and_suffix(self):
+        info = self.literal_info('abc[0-9]+')
+        self.assertEqual(info.prefix, 'abc')
+        self.assertEqual(info.suffix, '')
+        info = self.literal_info('x(ab)+y')
+        self.assertEqual((info.prefix, info.suffix), ('xab', 'aby'))
+
+    def test_extracts_required_literals(self):
+        self.assertEqual(self.literal_info('(foo|bar)baz').required,
+                         ('barbaz', 'foobaz'))
+        self.assertEqual(self.literal_info('[a-z]+@[a-z]+').required, ('@',))
+        self.assertEqual(self.literal_info('[a-z]*(ab)+[a-z]*').required,
+                         ('ab',))
+        self.assertIsNone(self.literal_info('a*').required)
+        self.assertIsNone(self.literal_info('(ab)?').required)
+
+    def test_exact_sets(self):
+        self.assertEqual(self.literal_info('ab?c').exact,
+                         frozenset(['abc', 'ac']))
+        self.assertIsNone(self.literal_info('a*').exact)
+        self.assertIsNone(self.literal_info('[a-z][a-z]').exact)
+
+    def test_no_prefilter_without_literals(self):
+        self.assertIsNone(Regex('[a-z]*').prefilter)
+        self.assertIsNone(Regex('(a|b)*').prefilter)
+
+    def test_rejects(self):
+        prefilter = Regex('abc[0-9]+x').prefilter
+        self.assertTrue(prefilter.rejects('abd1x'))
+        self.assertTrue(prefilter.rejects('abc1y'))
+        self.assertFalse(prefilter.rejects('abc1x'))
+        prefilter = Regex('[a-z]+@[a-z]+').prefilter
+        self.assertTrue(prefilter.rejects('nobody'))
+        self.assertFalse(prefilter.rejects('a@b'))
+
+    def test_binary_literals(self):
+        regex = Regex('caf\u00e9[0-9]', binary=True)
+        self.assertEqual(regex.prefilter.prefix, 'caf\u00e9'.encode('utf-8'))
+        self.assertTrue(regex.test('caf\u00e91'.encode('utf-8')))
+        self.assertFalse(regex.test(b'cafe1'))
+        self.assertTrue(regex.test(memoryview('caf\u00e91'.encode('utf-8'))))
+
+    def test_search_skips_to_literals(self):
+        regex = Regex('ne+dle[0-9]*')
+        text = 'x' * 1000 + 'needle42'
+        self.assertEqual(regex.search(text).span(), (1000, 1008))
+        self.assertIsNone(regex.search('x' * 1000))
+        self.assertEqual(Regex('[a-z]+@[a-z]+').findall('to a@b, c@d'),
+                         ['a@b', 'c@d'])
+
+    def test_agrees_with_program(self):
+        for expr in ('(foo|bar)baz', 'ab?c', 'x(ab)+y', '[a-c]*b[a-c]*'):
+            regex = Regex(expr)
+            for string in ('foobaz', 'barbaz', 'baz', 'abc', 'ac', 'xaby',
+                           'xababy', 'xy', 'b', 'aabcc', ''):
+                self.assertEqual(regex.test(string),
+                                 regex.program.simulate(string))
+
+
+class TestFastPath(unittest.TestCase):
+
+    def shape(self, expr, binary=False):
+        fast_path = Regex(expr, binary=binary).fast_path
+        return fast_path and fast_path.shape
+
+    def test_recognizes_shapes(self):
+        self.assertEqual(self.shape('hello'), 'strings')
+        self.assertEqual(self.shape('a|b|c'), 'strings')
+        self.assertEqual(self.shape('(foo|bar)baz'), 'strings')
+        self.assertEqual(self.shape('ab?'), 'strings')
+        self.assertEqual(self.shape('[a-z]+'), 'repeat')
+        self.assertEqual(self.shape('a*'), 'repeat')
+        self.assertEqual(self.shape('[A-Z][0-9][0-9]'), 'classes')
+        self.assertEqual(self.shape('a[bc]d'), 'classes')
+        self.assertIsNone(self.shape('(ab)*'))
+        self.assertIsNone(self.shape('a[a-z]*'))
+        self.assertIsNone(self.shape('[\u00e0-\u00ff]+', binary=True))
+
+    def test_bounds_total_length(self):
+        self.assertEqual(self.shape('a{0,100}'), 'strings')
+        regex = Regex('a{0,2000}')
+        self.assertIsNone(regex.fast_path)
+        self.assertTrue(regex.test('a' * 2000))
+        self.assertFalse(regex.test('a' * 2001))
+
+    def test_agrees_with_program(self):
+        cases = {
+            'hello': ['hello', 'hell', 'helloo', ''],
+            'a|b|c': ['a', 'b', 'c', 'd', 'ab', ''],
+            '(foo|bar)baz': ['foobaz', 'barbaz', 'baz', 'foobar'],
+            'ab?': ['a', 'ab', 'abb', 'b'],
+            '[a-z]+': ['abc', '', 'aBc', 'z'],
+            '[a-z]*': ['abc', '', 'aBc'],
+            '[a-z]?': ['a', '', 'ab', 'A'],
+            '[A-Z][0-9][0-9]': ['A12', 'a12', 'A1', 'A123', 'AB1'],
+            '[\u0000-\uffff]+': ['\u4e2d\u6587', '', 'a'],
+        }
+        for expr, strings in cases.items():
+            regex = Regex(expr)
+            self.assertIsNotNone(regex.fast_path, expr)
+            for string in strings:
+                self.assertEqual(regex.test(string),
+                                 regex.program.simulate(string))
+
+    def test_binary(self):
+        regex = Regex('caf\u00e9|tea', binary=True)
+        self.assertTrue(regex.test('caf\u00e9'.encode('utf-8')))
+        self.assertFalse(regex.test(b'cafe'))
+        self.assertTrue(regex.test(memoryview(b'tea')))
+        regex = Regex('[a-f0-9]+', binary=True)
+        self.assertTrue(regex.test(b'deadbeef'))
+        self.assertFalse(regex.test(b'dead beef'))
+
+
+class TestDFA(unittest.TestCase):
+
+    def test_agrees_with_nfa(self):
+        cases = {
+            'ab*': ['a', 'ab', 'abb', 'aab', ''],
+            '(a|b)*': ['', 'abba', 'abc'],
+            '(ab)+c': ['abc', 'ababc', 'abab', 'c'],
+            '([a-z]a)*': ['', 'zama', 'maa', '1a'],
+        }
+        for expr, strings in cases.items():
+            nfa_regex = Regex(expr)
+            dfa_regex = Regex(expr, dfa=True)
+            for string in strings:
+                self.assertEqual(dfa_regex.dfa.simulate(string),
+                                 nfa_regex.program.simulate(string))
+
+    def test_memoizes_transitions(self):
+        regex = Regex('(a|b)*', dfa=True)
+        self.assertTrue(regex.dfa.simulate('abab'))
+        class_id = regex.program.alphabet.classify(ord('a'))
+        self.assertIsNotNone(regex.dfa.start_state.next[class_id])
+        states = len(regex.dfa.states)
+        self.assertTrue(regex.dfa.simulate('babba'))
+        self.assertEqual(len(regex.dfa.states), states)
+
+    def test_flushes_cache_at_cap(self):
+        regex = Regex('abcd', dfa=True, max_dfa_states=2)
+        self.assertTrue(regex.dfa.simulate('abcd'))
+        self.assertFalse(regex.dfa.simulate('abc'))
+        self.assertGreater(regex.dfa.flushes, 0)
+        self.assertLessEqual(len(regex.dfa.states), 2)
+
+    def test_falls_back_to_nfa_when_thrashing(self):
+        regex = Regex('abcd', dfa=True, max_dfa_states=1)
+        for i in range(DFA.MAX_FLUSHES):
+            regex.dfa.simulate('abcd')
+        self.assertGreater(regex.dfa.flushes, DFA.MAX_FLUSHES)
+        self.assertTrue(regex.dfa.simulate('abcd'))
+        self.assertFalse(regex.dfa.simulate('abc'))
+
+
+class TestMinimalDFA(unittest.TestCase):
+
+    def test_agrees_with_program(self):
+        cases = {
+            '(a|a)*b': ['b', 'ab', 'aaab', 'aa', 'ba'],
+            'a((abc)*c)*': ['a', 'aabcc', 'aabc', 'ac', 'acc'],
+            '(ab)+c': ['abc', 'ababc', 'abab', 'c', 'abcc'],
+            '[a-z]+[0-9]*x': ['ax', 'abc12x', '12x', 'ab1', 'abx1'],
+            '([a-z]a)*': ['', 'zama', 'maa', '1a'],
+        }
+        for expr, strings in cases.items():
+            regex = Regex(expr, minimize=True)
+            self.assertIsNotNone(regex.minimal_dfa, expr)
+            for string in strings:
+                self.assertEqual(regex.minimal_dfa.simulate(string),
+                                 regex.program.simulate(string))
+                self.assertEqual(regex.test(string),
+                                 regex.program.simulate(string))
+
+    def test_merges_equivalent_states(self):
+        # start, after a run of a's, and the dead state; the accepting
+        # state after b
+        self.assertEqual(len(Regex('(a|a)*b', minimize=True).minimal_dfa), 3)
+        self.assertEqual(len(Regex('(a|b|ab)*', minimize=True).minimal_dfa),
+                         2)
+        self.assertEqual(len(Regex('a*a*a*', minimize=True).minimal_dfa), 2)
+
+    def test_respects_budget(self):
+        regex = Regex('[ab]*a[ab][ab][ab][ab][ab]', minimize=True,
+                      max_dfa_states=16)
+        self.assertIsNone(regex.minimal_dfa)
+        self.assertTrue(regex.test('bbabbbbb'))
+        self.assertIsNotNone(MinimalDFA.from_program(regex.program))
+
+    def test_binary(self):
+        regex = Regex('[a-z\u00e9]+', binary=True, minimize=True)
+        self.assertTrue(regex.minimal_dfa.simulate(
+            'caf\u00e9'.encode('utf-8')))
+        self.assertFalse(regex.minimal_dfa.simulate(b'caf\xc3'))
+
+
+class TestCodegen(unittest.TestCase):
+
+    def test_agrees_with_table(self):
+        strings = ['', 'a', 'ax', 'abc12x', '12x', 'ab1', 'abx1', 'zx9x']
+        for expr in ['[a-z]+[0-9]*x', '(a|a)*b', '(ab)?c?', 'a((abc)*c)*']:
+            regex = Regex(expr, codegen=True)
+            self.assertIsNotNone(regex.minimal_dfa.function, expr)
+            table = Regex(expr, minimize=True).minimal_dfa
+            for string in strings:
+                self.assertEqual(regex.minimal_dfa.simulate(string),
+                                 table.simulate(string), (expr, string))
+
+    def test_source(self):
+        source = Regex('ab', codegen=True).minimal_dfa.source()
+        self.assertTrue(source.startswith('def match(codes):'))
+        self.assertIn('code == 97', source)
+        self.assertIn('return False', source)
+
+    def test_binary(self):
+        regex = Regex('[\u00e9-\u4e00]+', binary=True, codegen=True)
+        self.assertTrue(regex.test('\u00e9\u4e00'.encode('utf-8')))
+        self.assertFalse(regex.test('\u00e9'.encode('utf-8')[:1]))
+
+    def test_state_budget(self):
+        expr = '[ab]*a[ab][ab][ab][ab][ab][ab][ab][ab]'
+        minimal_dfa = Regex(expr, minimize=True).minimal_dfa
+        self.assertGreater(len(minimal_dfa), MinimalDFA.MAX_CODEGEN_STATES)
+        self.assertIsNone(minimal_dfa.compile_function())
+        regex = Regex(expr, codegen=True)
+        self.assertTrue(regex.test('bbbabbbbbbbb'))
+        self.assertFalse(regex.test('bbbbbabbbbbb'))
+
+
+@unittest.skipIf(regex_module.numpy is None, 'numpy is not installed')
+class TestArray(unittest.TestCase):
+
+    def test_strings(self):
+        numpy = regex_module.numpy
+        regex = Regex('[A-Z][A-Z][0-9]+(x|yz)?')
+        strings = ['AB12', 'AB1x', 'ab12', '', 'AB12yz', 'AB', 'ZZ9\u00e9',
+                   'AB\u4e001']
+        self.assertEqual(regex.test_array(numpy.array(strings)).tolist(),
+                         [regex.test(string) for string in strings])
+        self.assertEqual(
+            regex.test_array(numpy.array(strings).reshape(2, 4)).shape,
+            (2, 4))
+
+    def test_bytes(self):
+        numpy = regex_module.numpy
+        regex = Regex('[0-9]+-[\u00e9]?', binary=True)
+        column = numpy.array([b'12-', b'1-\xc3\xa9', b'-', b'1-\xc3'])
+        self.assertEqual(regex.test_array(column).tolist(),
+                         [True, True, False, False])
+        with self.assertRaises(TypeError):
+            regex.test_array(numpy.array(['12-']))
+
+    def test_state_budget(self):
+        numpy = regex_module.numpy
+        regex = Regex('[ab]*a[ab][ab][ab][ab]', max_dfa_states=8)
+        with self.assertRaises(ValueError):
+            regex.test_array(numpy.array(['abbbb']))
+
+    def test_keeps_engine(self):
+        numpy = regex_module.numpy
+        regex = Regex('[a-z]+[0-9]')
+        regex.test_array(numpy.array(['ab1']))
+        self.assertIsNone(regex.minimal_dfa)
+        self.assertIsNotNone(regex.array_dfa)
+
+
+class TestArrayWithoutNumpy(unittest.TestCase):
+
+    def test_requires_numpy(self):
+        regex = Regex('[a-z]+[0-9]')
+        with unittest.mock.patch.object(regex_module, 'numpy', None):
+            with self.assertRaises(ImportError):
+                regex.test_array(['ab1'])
+        self.assertIsNone(regex.array_dfa)
+        self.assertTrue(regex.test('ab1'))
+
+
+class TestAsync(unittest.TestCase):
+
+    def test_atest(self):
+        regex = Regex('ab+c')
+        self.assertTrue(asyncio.run(regex.atest('a' + 'b' * 100 + 'c',
+                                                budget=7)))
+        self.assertFalse(asyncio.run(regex.atest('a' + 'b' * 100,
+                                                 budget=7)))
+        self.assertTrue(asyncio.run(regex.atest('abc')))
+
+    def test_atest_yields(self):
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0)
+
+        async def run():
+            task = asyncio.ensure_future(tick())
+            await asyncio.sleep(0)
+            result = await Regex('[ab]*').atest('ab' * 50, budget=10)
+            task.cancel()
+            return result
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertGreaterEqual(len(ticks), 10)
+
+    def test_asearch(self):
+        regex = Regex('ab+c')
+        string = 'x' * 100 + 'abbbc' + 'y' * 50 + 'abc'
+        for pos in [0, 50, 101, 150]:
+            match = asyncio.run(regex.asearch(string, pos, budget=7))
+            self.assertEqual(match and match.span(),
+                             regex.search(string, pos) and
+                             regex.search(string, pos).span())
+        binary = Regex('ab+c', binary=True)
+        match = asyncio.run(binary.asearch(string.encode('utf-8'), budget=7))
+        self.assertEqual(match.span(), (100, 105))
+
+    def test_feed_reader(self):
+        async def run(matcher, data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            found = await matcher.feed_reader(reader, size=3)
+            return found, matcher.finish()
+
+        data = '\u00e9\u00e9abbc \u00e9'.encode('utf-8')
+        self.assertEqual(
+            asyncio.run(run(Regex('\u00e9').matcher(search=True), data)),
+            ([(0, 1), (1, 2)], [(7, 8)]))
+        self.assertEqual(
+            asyncio.run(run(Regex('[a-z\u00e9 ]*').matcher(), data)),
+            ([], True))
+        self.assertEqual(
+            asyncio.run(run(Regex('ab+c', binary=True).matcher(search=True),
+                            data)),
+            ([(4, 8)], []))
+
+
+class TestStats(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        regex = Regex('(a|b)*abb')
+        self.assertIsNone(regex.stats())
+        regex.enable_stats()
+        regex.disable_stats()
+        self.assertTrue(regex.test('abb'))
+        self.assertIsNone(regex.stats())
+
+    def test_records_program(self):
+        regex = Regex('(a|b)*abb')
+        regex.prefilter = None
+        regex.enable_stats()
+        self.assertTrue(regex.test('ababb'))
+        self.assertFalse(regex.test('abab'))
+        stats = regex.stats()
+        self.assertEqual(stats['states'], len(regex.program.ops))
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['chars'], 9)
+        self.assertEqual(stats['steps'], 9)
+        self.assertEqual(stats['peak_active_states'], 4)
+        self.assertEqual(stats['average_active_states'], 4.0)
+        self.assertEqual(stats['closure_expansions'], 18)
+        self.assertEqual(stats['engines'], {'program': 2})
+
+    def test_records_dfa_cache(self):
+        regex = Regex('(a|b)*abb', dfa=True)
+        regex.prefilter = None
+        regex.enable_stats()
+        regex.test('ababb')
+        regex.test('ababb')
+        stats = regex.stats()
+        # the second a after ab is already cached
+        self.assertEqual(stats['dfa_misses'], 4)
+        self.assertEqual(stats['dfa_hits'], 6)
+        self.assertEqual(stats['engines'], {'dfa': 2})
+
+    def test_sink(self):
+        calls = []
+        regex = Regex('ab|cd')
+        regex.enable_stats(lambda regex, stats: calls.append(stats))
+        regex.test('ab')
+        regex.test('xyz')
+        self.assertEqual([stats['engines'] for stats in calls],
+                         [{'fast_path': 1}, {'fast_path': 1}])
+        self.assertEqual(regex.stats()['calls'], 2)
+
+    def test_records_limited_calls(self):
+        calls = []
+        regex = Regex('(a|b)*c(a|b)', dfa=True)
+        regex.prefilter = None
+        regex.enable_stats(lambda regex, stats: calls.append(stats))
+        self.assertTrue(regex.test('abca', limits=Limits(max_chars=10)))
+        with self.assertRaises(LimitExceeded):
+            regex.test('ab' * 5000, limits=Limits(max_steps=100))
+        self.assertEqual([stats['engines'] for stats in calls],
+                         [{'dfa': 1}, {'dfa': 1}])
+        self.assertEqual(calls[0]['chars'], 4)
+        stats = regex.stats()
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['dfa_hits'] + stats['dfa_misses'],
+                         stats['chars'])
+
+
+class TestLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.regex = Regex('(a|b)*c(a|b)')
+        self.regex.prefilter = None
+        self.string = 'ab' * 5000 + 'ca'
+
+    def test_within_limits(self):
+        limits = Limits(max_chars=20000, max_steps=10 ** 6, timeout=60)
+        self.assertTrue(self.regex.test(self.string, limits=limits))
+        self.assertFalse(self.regex.test('ab' * 10, limits=limits))
+        match = self.regex.search('xx' + self.string, limits=limits)
+        self.assertEqual(match.span(), (2, 10004))
+
+    def test_raises(self):
+        for limits in [Limits(max_chars=100), Limits(max_steps=1000),
+                       Limits(timeout=0)]:
+            with self.assertRaises(LimitExceeded):
+                self.regex.test(self.string, limits=limits)
+            with self.assertRaises(LimitExceeded):
+                self.regex.search(self.string, limits=limits)
+
+    def test_dfa_steps(self):
+        for regex in [Regex('(a|b)*c(a|b)', dfa=True),
+                      Regex('(a|b)*c(a|b)', minimize=True)]:
+            regex.prefilter = None
+            self.assertTrue(regex.test(self.string,
+                                       limits=Limits(max_steps=20000)))
+            with self.assertRaises(LimitExceeded):
+                regex.test(self.string, limits=Limits(max_steps=5000))
+
+    def test_stops_when_nothing_can_match(self):
+        # the input runs out of budget only if it is read past the 'x'
+        limits = Limits(max_steps=10000)
+        string = 'abx' + 'ab' * 10000
+        for regex in [Regex('(a|b)*c(a|b)'), Regex('(a|b)*c(a|b)', dfa=True),
+                      Regex('(a|b)*c(a|b)', minimize=True)]:
+            regex.prefilter = None
+            self.assertFalse(regex.test(string, limits=limits))
+            self.assertFalse(regex.test(string))
+
+    def test_stops_when_everything_matches(self):
+        limits = Limits(max_steps=2000)
+        for regex in [Regex('ab[\u0000-\U0010ffff]*', minimize=True),
+                      Regex('ab[\u0000-\U0010ffff]*', codegen=True)]:
+            regex.fast_path = None
+            dfa = regex.minimal_dfa
+            self.assertNotEqual(dfa.universal, -1)
+            self.assertEqual(dfa.run(0, map(ord, 'abc' * 100)), dfa.universal)
+            self.assertTrue(regex.test('ab' + 'c' * 5000, limits=limits))
+            self.assertTrue(regex.test('ab' + 'c' * 5000))
+            self.assertFalse(regex.test('ba'))
+
+
+class TestArchive(unittest.TestCase):
+
+    exprs = ['(a|a)*b', '[a-z]+x', 'ab', '[ab]*a[ab][ab][ab]',
+             '[\u00e9-\u4e00]+']
+    strings = ['', 'b', 'aab', 'zzx', 'ab', 'abab', 'bbabbb',
+               '\u00ff\u1234', 'x\u00e9']
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'rules.rgxa')
+
+    def test_round_trip(self):
+        Archive.dump(self.exprs, self.path, max_dfa_states=8)
+        with Archive.load(self.path) as archive:
+            self.assertEqual(archive.exprs, self.exprs)
+            self.assertEqual(len(archive), 5)
+            # the fourth pattern's DFA is over budget
+            self.assertEqual([dfa is None for dfa in archive.dfas],
+                             [False, False, False, True, False])
+            regex_set = RegexSet(self.exprs)
+            for string in self.strings:
+                self.assertEqual(archive.matches(string),
+                                 regex_set.matches(string))
+            self.assertEqual(archive.regex(1).search('12abx').span(), (2, 5))
+
+    def test_binary(self):
+        Archive.dump(self.exprs, self.path, binary=True)
+        with Archive.load(self.path) as archive:
+            self.assertTrue(archive.binary)
+            self.assertEqual(archive.matches('\u00ff'.encode('utf-8')), [4])
+            self.assertEqual(archive.matches(b'aab'), [0])
+            with self.assertRaises(TypeError):
+                archive.matches('aab')
+
+    def test_rejects_bad_files(self):
+        Archive.dump(self.exprs, self.path)
+        with open(self.path, 'rb') as stream:
+            data = bytearray(stream.read())
+        data[-1] ^= 1
+        with self.assertRaisesRegex(ValueError, 'checksum'):
+            Archive.from_buffer(bytes(data))
+        with self.assertRaisesRegex(ValueError, 'not a regex archive'):
+            Archive.from_buffer(b'RGXB' + bytes(data[4:]))
+        data[4] += 1
+        with self.assertRaisesRegex(ValueError, 'version'):
+            Archive.from_buffer(bytes(data))
+
+    def test_close_with_dfa_held(self):
+        Archive.dump(self.exprs, self.path)
+        with Archive.load(self.path) as archive:
+            dfa = archive.dfas[0]
+            self.assertTrue(dfa.simulate('aab'))
+        self.assertEqual(archive.dfas, [])
+        self.assertIsNone(archive.mapping)
+        with self.assertRaises(ValueError):
+            dfa.simulate('aab')
+
+    def test_precompile(self):
+        rules = self.path + '.txt'
+        with open(rules, 'w') as stream:
+            stream.write('ab\n\n[a-z]+x\n')
+        regex_module.precompile([rules, self.path])
+        with Archive.load(self.path) as archive:
+            self.assertEqual(archive.exprs, ['ab', '[a-z]+x'])
+            self.assertEqual(archive.matches('abx'), [1])
+
+    def test_precompile_flag(self):
+        rules = self.path + '.txt'
+        with open(rules, 'w') as stream:
+            stream.write('ab\n')
+        argv = ['regex.py', '--precompile', rules, self.path]
+        with unittest.mock.patch('sys.argv', argv):
+            regex_module.main()
+        with Archive.load(self.path) as archive:
+            self.assertEqual(archive.exprs, ['ab'])
+        argv = ['regex.py', 'precompile', 'precompile']
+        with unittest.mock.patch('sys.argv', argv), \
+                unittest.mock.patch('builtins.print') as print_:
+            regex_module.main()
+        print_.assert_called_once_with('precompile')
+
+
+class TestTestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.regex = Regex('[a-z]+[0-9]*')
+        self.strings = ['abc', 'ab12', '12', '', 'x9', 'A'] * 50
+        self.expected = [self.regex.test(string) for string in self.strings]
+
+    def test_batch(self):
+        urls = ['http://example/a/b{i}'.format(i=i) for i in range(50)]
+        urls += ['http://example/a/', 'http://example/a', '',
+                 'http://example/a/b', 'http://example/a/b12x']
+        for dfa in (False, True):
+            regex = Regex('http://example/a/b[0-9]+', dfa=dfa)
+            self.assertEqual(regex.test_batch(urls),
+                             [regex.test(url) for url in urls])
+        self.assertEqual(self.regex.test_batch(self.strings), self.expected)
+        self.assertEqual(self.regex.test_batch([]), [])
+
+    def test_batch_after_dead_prefix(self):
+        regex = Regex('ab*')
+        self.assertEqual(regex.test_batch(['ba', 'bab', 'b', 'abb', 'a']),
+                         [False, False, False, True, True])
+        binary = Regex('ab*', binary=True)
+        self.assertEqual(binary.test_batch([b'abb', b'ab', b'b']),
+                         [True, True, False])
+
+    def test_batch_of_memoryviews(self):
+        binary = Regex('ab*', binary=True)
+        strings = [memoryview(b'abb'), memoryview(b'ba'), bytearray(b'ab'),
+                   memoryview(b'xabbbx')[1:5]]
+        self.assertEqual(binary.test_batch(strings), [True, False, True, True])
+
+
+class TestTestMany(unittest.TestCase):
+
+    def setUp(self):
+        self.regex = Regex('[a-z]+[0-9]*')
+        self.strings = ['abc', 'ab12', '12', '', 'x9', 'A'] * 50
+        self.expected = [self.regex.test(string) for string in self.strings]
+
+    def test_pickles_as_pattern(self):
+        regex = pickle.loads(pickle.dumps(Regex('ab*', dfa=True)))
+        self.assertEqual(regex.expr, 'ab*')
+        self.assertIsNotNone(regex.dfa)
+        self.assertTrue(regex.test('abb'))
+
+    def test_in_process(self):
+        self.assertEqual(list(self.regex.test_many(self.strings, workers=1)),
+                         self.expected)
+
+    def test_worker_pool(self):
+        results = self.regex.test_many(iter(self.strings), workers=2,
+                                       chunksize=7)
+        self.assertEqual(list(results), self.expected)
+
+    def test_mask(self):
+        mask = self.regex.test_many(self.strings, workers=2, chunksize=50,
+                                    mask=True)
+        self.assertEqual(mask, bytearray(self.expected))
+
+
+class TestRegexSet(unittest.TestCase):
+
+    def setUp(self):
+        self.patterns = ['ab*', '[a-z]+', '[0-9]+', '(ab)+c', 'a?b']
+
+    def test_agrees_with_individual_patterns(self):
+        regexes = [Regex(expr) for expr in self.patterns]
+        for dfa in (False, True):
+            regex_set = RegexSet(self.patterns, dfa=dfa)
+            for string in ('', 'a', 'ab', 'abb', 'b', 'ababc', '123', 'x1'):
+                expected = [index for index, regex in enumerate(regexes)
+                            if regex.test(string)]
+                self.assertEqual(regex_set.matches(string), expected)
+                self.assertEqual(regex_set.test(string), bool(expected))
+
+    def test_tags_accept_states(self):
+        regex_set = RegexSet(['a', 'b', 'c'])
+        program = regex_set.program
+        for state_id, op in enumerate(program.ops):
+            if op == OP_MATCH:
+                self.assertIn(program.tags[state_id], (0, 1, 2))
+            else:
+                self.assertEqual(program.tags[state_id], -1)
+        self.assertEqual(regex_set.matches('c'), [2])
+
+    def test_many_patterns(self):
+        patterns = ['k{i}x*'.format(i=i) for i in range(500)]
+        regex_set = RegexSet(patterns)
+        self.assertEqual(len(regex_set), 500)
+        self.assertEqual(regex_set.matches('k42xx'), [42])
+        self.assertEqual(regex_set.matches('k4'), [4])
+        self.assertEqual(regex_set.matches('k'), [])
+
+    def test_binary(self):
+        regex_set = RegexSet(['\u00e9+', '[a-z\u00e9]+'], binary=True)
+        self.assertEqual(regex_set.matches('\u00e9'.encode('utf-8')), [0, 1])
+        self.assertRaises(TypeError, regex_set.matches, 'a')
+        self.assertRaises(ValueError, RegexSet, [Regex('a')], binary=True)
+
+    def test_empty(self):
+        self.assertEqual(RegexSet([]).matches('a'), [])
+        self.assertFalse(RegexSet([]).test(''))
+
+
+class TestPatternCache(unittest.TestCase):
+
+    def test_reuses_compiled_patterns(self):
+        cache = PatternCache()
+        regex = cache.get('ab*')
+        self.assertIs(cache.get('ab*'), regex)
+        self.assertIsNot(cache.get('ab*', dfa=True), regex)
+        self.assertIsNot(cache.get('ab*', binary=True), regex)
+        self.assertEqual(cache.info(), {
+            'hits': 1, 'misses': 3, 'size': 3, 'max_size': 512})
+
+    def test_evicts_least_recently_used(self):
+        cache = PatternCache(max_size=2)
+        a = cache.get('a')
+        cache.get('b')
+        cache.get('a')
+        cache.get('c')
+        self.assertIs(cache.get('a'), a)
+        self.assertEqual(cache.info()['size'], 2)
+        self.assertEqual(cache.info()['misses'], 3)
+        cache.resize(1)
+        self.assertEqual(cache.info()['size'], 1)
+
+    def test_purge(self):
+        cache = PatternCache()
+        regex = cache.get('a')
+        cache.purge()
+        self.assertIsNot(cache.get('a'), regex)
+        self.assertEqual(cache.info()['misses'], 1)
+
+    def test_thread_safe(self):
+        cache = PatternCache(max_size=8)
+
+        def compile_patterns():
+            for i in range(200):
+                self.assertTrue(cache.get('a{i}'.format(i=i % 16)).test(
+                    'a{i}'.format(i=i % 16)))
+
+        threads = [threading.Thread(target=compile_patterns)
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = cache.info()
+        self.assertEqual(info['hits'] + info['misses'], 800)
+        self.assertLessEqual(info['size'], 8)
+
+    def test_module_compile(self):
+        regex_module.purge()
+        regex = regex_module.compile('(ab)+')
+        self.assertIs(regex_module.compile('(ab)+'), regex)
+        self.assertTrue(regex.test('abab'))
+        self.assertEqual(regex_module.cache.info()['hits'], 1)
+        regex_module.purge()
+        self.assertEqual(regex_module.cache.info()['size'], 0)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_measure(self):
+        result = measure(lambda: Regex('ab').test('ab'), 2, 0.01)
+        self.assertGreater(result['ops_per_sec'], 0)
+        self.assertGreater(result['ns_per_char'], 0)
+        self.assertGreater(result['peak_memory'], 0)
+        self.assertIsNone(measure(lambda: None, None, 0.01)['ns_per_char'])
+
+    def test_compare(self):
+        baseline = {'fast': {'ops_per_sec': 100.0},
+                    'slow': {'ops_per_sec': 100.0}}
+        results = {'fast': {'ops_per_sec': 90.0},
+                   'slow': {'ops_per_sec': 50.0},
+                   'new': {'ops_per_sec': 1.0}}
+        with unittest.mock.patch('sys.stderr'):
+            self.assertEqual(compare(results, baseline, 0.25), ['slow'])
+
+
 if __name__ == '__main__':
     unittest.main()